@@ -0,0 +1,279 @@
+""" Offline end-to-end benchmarks for the gptsql hot paths.
+
+    Drives GPTSql.process_command (the chat loop's async run driver, on a fresh event
+    loop per turn) against the in-process Assistants stand-in in
+    fake_openai.py and a local database seeded with synthetic tables, and times
+    call_my_function on its own. Prints a JSON report:
+
+        python -m benchmarks.bench --rows 200000 --turns 20 --output bench.json
+
+    Pass --db-url to run against a throwaway Postgres/SingleStore instead of SQLite.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+import io
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from gptsql import func_tools, serialize
+from gptsql.connections import ConnectionManager
+from gptsql.utils import StepPrinter
+from gptsql.__main__ import GPTSql
+from .fake_openai import AsyncFakeOpenAI, FakeOpenAI
+
+SCENARIOS = {
+    "single_query": [
+        {"tool_calls": [{"name": "run_sql_command", "arguments": {
+            "query": "SELECT * FROM bench_orders ORDER BY amount DESC"}}]},
+        {"message": "Here are the largest orders."},
+    ],
+    "parallel_queries": [
+        {"tool_calls": [
+            {"name": "run_sql_command", "arguments": {
+                "query": "SELECT status, count(*) AS n, sum(amount) AS total FROM bench_orders GROUP BY status"}},
+            {"name": "run_sql_command", "arguments": {
+                "query": "SELECT c.region, count(*) AS n FROM bench_orders o JOIN bench_customers c ON c.id = o.customer_id GROUP BY c.region"}},
+            {"name": "run_sql_command", "arguments": {
+                "query": "SELECT * FROM bench_customers ORDER BY name"}},
+        ]},
+        {"message": "Summary by status and region."},
+    ],
+    "multi_step": [
+        {"tool_calls": [{"name": "run_sql_command", "arguments": {
+            "query": "SELECT * FROM bench_customers WHERE region = 'west'"}}]},
+        {"tool_calls": [{"name": "run_sql_command", "arguments": {
+            "query": "SELECT customer_id, sum(amount) AS total FROM bench_orders GROUP BY customer_id ORDER BY total DESC"}}]},
+        {"tool_calls": [{"name": "get_query_results_page", "arguments": {"start_row": 1000, "num_rows": 20}}]},
+        {"message": "Top customers in the west region."},
+    ],
+}
+
+def seed_database(engine, rows, customers):
+    rng = random.Random(42)
+    regions = ["north", "south", "east", "west"]
+    statuses = ["new", "paid", "shipped", "refunded"]
+    pd.DataFrame({
+        "id": range(customers),
+        "name": [f"customer {i:06d}" for i in range(customers)],
+        "region": [rng.choice(regions) for _ in range(customers)],
+    }).to_sql("bench_customers", engine, if_exists="replace", index=False, chunksize=10_000)
+    pd.DataFrame({
+        "id": range(rows),
+        "customer_id": [rng.randrange(customers) for _ in range(rows)],
+        "amount": [round(rng.uniform(1, 1000), 2) for _ in range(rows)],
+        "status": [rng.choice(statuses) for _ in range(rows)],
+        "note": ["lorem ipsum dolor sit amet " * rng.randint(0, 8) for _ in range(rows)],
+        "created_at": pd.date_range("2023-01-01", periods=rows, freq="min"),
+    }).to_sql("bench_orders", engine, if_exists="replace", index=False, chunksize=10_000)
+
+def make_app(engine, client, workdir, max_parallel_queries):
+    # Build a GPTSql without the interactive setup in __init__
+    app = GPTSql.__new__(GPTSql)
+    app.CONFIG_FILE = os.path.join(workdir, "gptsql.json")
+    app.STATE_FILE = os.path.join(workdir, "gptsql_state.json")
+    app.config = {"model": "fake"}
+    app.load_state()
+    app.started_at = time.perf_counter()
+    app.timings = []
+    app.db = ConnectionManager(engine.url, pool_size=max_parallel_queries + 1, max_overflow=max_parallel_queries)
+    app._engine_lock = threading.Lock()
+    app.max_parallel_queries = max_parallel_queries
+    app.turn_queries = []
+    app.oaclient = client
+    app.async_oaclient = AsyncFakeOpenAI(client)
+    app.executor = ThreadPoolExecutor(max_workers=max_parallel_queries, thread_name_prefix="gptsql-sql")
+    app.assistant = client.beta.assistants.create(model="fake")
+    app.thread = client.beta.threads.create()
+    app.spinner = StepPrinter(quiet=True)
+    return app
+
+class Timers:
+    """ Wraps the SQL and serialization entry points so each turn can report their time. """
+    def __init__(self):
+        self.sql = 0.0
+        self.serialize = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, name, elapsed):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + elapsed)
+
+    def reset(self):
+        self.sql = self.serialize = 0.0
+
+    @contextmanager
+    def installed(self):
+        timers = self
+        orig_result, orig_serialize = func_tools.StreamedResult, serialize.serialize_result
+
+        class TimedResult(orig_result):
+            def __init__(self, *args, **kwargs):
+                start = time.perf_counter()
+                super().__init__(*args, **kwargs)
+                timers.add("sql", time.perf_counter() - start)
+
+            def page(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return super().page(*args, **kwargs)
+                finally:
+                    timers.add("sql", time.perf_counter() - start)
+
+        def timed_serialize(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return orig_serialize(*args, **kwargs)
+            finally:
+                timers.add("serialize", time.perf_counter() - start)
+
+        func_tools.StreamedResult = TimedResult
+        serialize.serialize_result = timed_serialize
+        try:
+            yield self
+        finally:
+            func_tools.StreamedResult = orig_result
+            serialize.serialize_result = orig_serialize
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    def pct(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {
+        "p50": round(pct(50), 3),
+        "p90": round(pct(90), 3),
+        "p99": round(pct(99), 3),
+        "mean": round(statistics.fmean(values), 3),
+        "max": round(values[-1], 3),
+    }
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return round(rss / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+def bench_turns(engine, args, workdir):
+    report = {}
+    timers = Timers()
+    for name, steps in SCENARIOS.items():
+        client = FakeOpenAI(
+            script=[steps] * args.turns,
+            latency=args.api_latency_ms / 1000,
+            step_latency=args.step_latency_ms / 1000,
+            stream=not args.poll,
+        )
+        app = make_app(engine, client, workdir, args.max_parallel_queries)
+        latencies, sql, ser, calls, sent = [], [], [], [], []
+        with timers.installed():
+            for _ in range(args.turns):
+                if not args.with_cache:
+                    func_tools.result_cache.invalidate()
+                client.reset_counters()
+                timers.reset()
+                start = time.perf_counter()
+                with redirect_stdout(io.StringIO()):
+                    app.process_command(app.thread, "benchmark question")
+                    app.display_messages()
+                    app.flush_state()
+                latencies.append((time.perf_counter() - start) * 1000)
+                sql.append(timers.sql * 1000)
+                ser.append(timers.serialize * 1000)
+                calls.append(sum(client.calls.values()))
+                sent.append(client.bytes_sent)
+        report[name] = {
+            "turn_ms": summarize(latencies),
+            "sql_ms": summarize(sql),
+            "serialize_ms": summarize(ser),
+            "api_calls_per_turn": summarize(calls),
+            "bytes_sent_per_turn": summarize(sent),
+        }
+    return report
+
+def bench_call_my_function(engine, args):
+    report = {}
+    cases = {
+        "preview_large_result": ("run_sql_command", {"query": "SELECT * FROM bench_orders"}),
+        "aggregate": ("run_sql_command", {"query": "SELECT status, avg(amount) FROM bench_orders GROUP BY status"}),
+        "page_deep": ("get_query_results_page", {"start_row": max(0, args.rows - 50), "num_rows": 20}),
+    }
+    timers = Timers()
+    with timers.installed():
+        for name, (fname, fargs) in cases.items():
+            total, sql, ser, size = [], [], [], 0
+            for _ in range(args.repeat):
+                if not args.with_cache:
+                    func_tools.result_cache.invalidate()
+                if name == "page_deep":
+                    # Time from the preview being sent to the deep page being readable,
+                    # which includes waiting for the background spill
+                    with redirect_stdout(io.StringIO()):
+                        func_tools.call_my_function(engine, "run_sql_command", {"query": "SELECT * FROM bench_orders"})
+                timers.reset()
+                start = time.perf_counter()
+                with redirect_stdout(io.StringIO()):
+                    out = func_tools.call_my_function(engine, fname, fargs)
+                total.append((time.perf_counter() - start) * 1000)
+                sql.append(timers.sql * 1000)
+                ser.append(timers.serialize * 1000)
+                size = len(str(out).encode())
+            report[name] = {
+                "total_ms": summarize(total),
+                "sql_ms": summarize(sql),
+                "serialize_ms": summarize(ser),
+                "output_bytes": size,
+            }
+    return report
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline gptsql benchmarks")
+    parser.add_argument("--db-url", help="Database to seed and query (default: a temporary SQLite file)")
+    parser.add_argument("--rows", type=int, default=100_000, help="Rows in bench_orders")
+    parser.add_argument("--customers", type=int, default=5_000, help="Rows in bench_customers")
+    parser.add_argument("--turns", type=int, default=10, help="Turns per scenario")
+    parser.add_argument("--repeat", type=int, default=10, help="Repetitions per call_my_function case")
+    parser.add_argument("--api-latency-ms", type=float, default=20, help="Latency of each fake API call")
+    parser.add_argument("--step-latency-ms", type=float, default=200, help="Model thinking time per run step")
+    parser.add_argument("--max-parallel-queries", type=int, default=4)
+    parser.add_argument("--poll", action="store_true", help="Make the fake client refuse streaming")
+    parser.add_argument("--with-cache", action="store_true", help="Keep the result cache between turns")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="gptsql-bench-")
+    engine = create_engine(args.db_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+
+    start = time.perf_counter()
+    seed_database(engine, args.rows, args.customers)
+    seed_s = time.perf_counter() - start
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k != "db_url"},
+        "database": engine.dialect.name,
+        "seed_s": round(seed_s, 3),
+        "turns": bench_turns(engine, args, workdir),
+        "call_my_function": bench_call_my_function(engine, args),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out)
+    else:
+        print(out)
+
+if __name__ == "__main__":
+    main()
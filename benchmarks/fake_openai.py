@@ -0,0 +1,241 @@
+""" In-process stand-in for the parts of the OpenAI Assistants API that gptsql uses.
+
+    Runs follow a script: each turn is a list of steps, where a step either asks for
+    a batch of tool calls or posts the final assistant message. Every API call sleeps
+    for `latency` seconds and each model step for `step_latency`, so turn latency can
+    be measured without a network. Calls are counted per endpoint.
+
+    FakeOpenAI stands in for openai.OpenAI and AsyncFakeOpenAI for openai.AsyncOpenAI;
+    wrap the former in the latter so both clients see the same threads and runs.
+"""
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from itertools import count
+import json
+import threading
+import time
+from types import SimpleNamespace as NS
+
+class FakeStream:
+    def __init__(self, events):
+        self.events = events
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.events.close()
+
+    def __iter__(self):
+        return self.events
+
+class FakeRun:
+    def __init__(self, client, thread, steps):
+        self.client = client
+        self.thread = thread
+        self.steps = list(steps)
+        self.obj = NS(
+            id=client.new_id("run"), thread_id=thread.id, status="queued",
+            required_action=None, last_error=None
+        )
+        self.message = None
+        self.changed_at = time.perf_counter()
+
+    def advance(self, think=True):
+        """ Think for one step, then either request tool calls or finish the run. """
+        if think:
+            time.sleep(self.client.step_latency)
+        step = self.steps.pop(0) if self.steps else {"message": "done"}
+        if "tool_calls" in step:
+            calls = [
+                NS(id=self.client.new_id("call"), type="function",
+                   function=NS(name=c["name"], arguments=json.dumps(c.get("arguments", {}))))
+                for c in step["tool_calls"]
+            ]
+            self.obj.status = "requires_action"
+            self.obj.required_action = NS(type="submit_tool_outputs", submit_tool_outputs=NS(tool_calls=calls))
+        else:
+            self.message = self.client.add_message(self.thread, "assistant", step["message"])
+            self.obj.status = "completed"
+            self.obj.required_action = None
+        self.changed_at = time.perf_counter()
+
+    def events(self):
+        if self.obj.status == "queued":
+            yield NS(event="thread.run.created", data=self.obj)
+        self.obj.status = "in_progress"
+        self.advance()
+        if self.obj.status == "requires_action":
+            yield NS(event="thread.run.requires_action", data=self.obj)
+        else:
+            yield NS(event="thread.run.step.completed", data=NS(step_details=[("type", "message_creation")]))
+            text = self.message.content[0].text.value
+            yield NS(event="thread.message.delta", data=NS(delta=NS(content=[
+                NS(type="text", text=NS(value=text))
+            ])))
+            yield NS(event="thread.message.completed", data=self.message)
+            yield NS(event="thread.run.completed", data=self.obj)
+
+class FakeOpenAI:
+    def __init__(self, script=None, latency=0.0, step_latency=0.0, stream=True):
+        self.script = list(script or [])
+        self.latency = latency
+        self.step_latency = step_latency
+        self.stream = stream
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.threads_by_id = {}
+        self.runs = {}
+        self._ids = count(1)
+        self._clock = count(1)
+        self.lock = threading.Lock()
+
+        self.beta = NS(
+            assistants=NS(
+                create=self._endpoint("assistants.create", self.create_assistant),
+                retrieve=self._endpoint("assistants.retrieve", lambda assistant_id: self.assistant),
+                update=self._endpoint("assistants.update", lambda assistant_id, **kw: self.assistant),
+            ),
+            threads=NS(
+                create=self._endpoint("threads.create", self.create_thread),
+                retrieve=self._endpoint("threads.retrieve", lambda thread_id: self.threads_by_id[thread_id]),
+                messages=NS(
+                    create=self._endpoint("messages.create", self.create_message),
+                    list=self._endpoint("messages.list", self.list_messages),
+                ),
+                runs=NS(
+                    create=self._endpoint("runs.create", self.create_run),
+                    retrieve=self._endpoint("runs.retrieve", self.retrieve_run),
+                    cancel=self._endpoint("runs.cancel", lambda thread_id, run_id: self.runs[run_id].obj),
+                    submit_tool_outputs=self._endpoint("runs.submit_tool_outputs", self.submit_tool_outputs),
+                    steps=NS(list=self._endpoint("runs.steps.list", lambda thread_id, run_id, **kw: [])),
+                ),
+            ),
+        )
+        self.assistant = None
+
+    def _endpoint(self, name, func):
+        def call(*args, **kwargs):
+            with self.lock:
+                self.calls[name] += 1
+            time.sleep(self.latency)
+            return func(*args, **kwargs)
+        return call
+
+    def new_id(self, prefix):
+        return f"{prefix}_{next(self._ids)}"
+
+    def reset_counters(self):
+        self.calls = Counter()
+        self.bytes_sent = 0
+
+    def create_assistant(self, **kwargs):
+        self.assistant = NS(id=self.new_id("asst"), model=kwargs.get("model"), tools=[])
+        return self.assistant
+
+    def create_thread(self):
+        thread = NS(id=self.new_id("thread"), messages=[])
+        self.threads_by_id[thread.id] = thread
+        return thread
+
+    def add_message(self, thread, role, text):
+        msg = NS(
+            id=self.new_id("msg"), role=role, created_at=next(self._clock),
+            content=[NS(text=NS(value=text))]
+        )
+        thread.messages.append(msg)
+        return msg
+
+    def create_message(self, thread_id, role, content):
+        self.bytes_sent += len(content.encode())
+        return self.add_message(self.threads_by_id[thread_id], role, content)
+
+    def list_messages(self, thread_id, order="desc", after=None, limit=None, **kwargs):
+        messages = list(self.threads_by_id[thread_id].messages)
+        if order == "desc":
+            messages.reverse()
+        if after is not None:
+            ids = [m.id for m in messages]
+            messages = messages[ids.index(after) + 1:] if after in ids else messages
+        return messages[:limit] if limit else messages
+
+    def create_run(self, thread_id, assistant_id, stream=False, **kwargs):
+        if stream and not self.stream:
+            raise TypeError("create() got an unexpected keyword argument 'stream'")
+        steps = self.script.pop(0) if self.script else [{"message": "done"}]
+        run = FakeRun(self, self.threads_by_id[thread_id], steps)
+        self.runs[run.obj.id] = run
+        if stream:
+            return FakeStream(run.events())
+        return run.obj
+
+    def retrieve_run(self, thread_id, run_id):
+        run = self.runs[run_id]
+        if run.obj.status in ["queued", "in_progress"]:
+            run.obj.status = "in_progress"
+            # When polled, the step's thinking time passes on the wall clock
+            if time.perf_counter() - run.changed_at >= self.step_latency:
+                run.advance(think=False)
+        return run.obj
+
+    def submit_tool_outputs(self, thread_id, run_id, tool_outputs, stream=False):
+        self.bytes_sent += sum(len(o["output"].encode()) for o in tool_outputs)
+        run = self.runs[run_id]
+        run.obj.status = "queued" if not stream else "in_progress"
+        run.obj.required_action = None
+        run.changed_at = time.perf_counter()
+        if stream:
+            return FakeStream(run.events())
+        return run.obj
+
+class AsyncFakeStream:
+    """ A FakeStream read with `async with` / `async for`. Events are produced in a
+        worker thread, since the fake sleeps to simulate model latency.
+    """
+    def __init__(self, stream, executor):
+        self.events = stream.events
+        self.executor = executor
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        try:
+            self.events.close()
+        except ValueError:
+            # A cancelled turn can leave the generator running in its worker
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await asyncio.get_running_loop().run_in_executor(self.executor, next, self.events, None)
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+class AsyncFakeOpenAI:
+    """ Async client over the same state as `client`: each endpoint runs the sync one
+        in a worker thread, and streamed runs come back as AsyncFakeStreams. The workers
+        only sleep, so there are enough of them that simulated latency never queues.
+    """
+    def __init__(self, client, max_workers=64):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fake-openai")
+        self.beta = self._namespace(client.beta)
+
+    def _namespace(self, ns):
+        return NS(**{
+            name: self._namespace(value) if isinstance(value, NS) else self._endpoint(value)
+            for name, value in vars(ns).items()
+        })
+
+    def _endpoint(self, func):
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+            return AsyncFakeStream(result, self.executor) if isinstance(result, FakeStream) else result
+        return call
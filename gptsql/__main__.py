@@ -1,21 +1,28 @@
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
 from datetime import datetime
 import importlib.metadata
 import json
 import os
-import psycopg2
-import singlestoredb as s2
+import re
+import sys
+import threading
 import time
-import toml
 
-from openai import OpenAI
-import openai
+# Heavier modules (openai, sqlalchemy, pandas, the database drivers) are imported
+# where they are first used so the prompt comes up quickly.
 from prompt_toolkit import PromptSession, prompt
 from prompt_toolkit.history import FileHistory
-from halo import Halo
-from sqlalchemy import create_engine
+from prompt_toolkit.patch_stdout import patch_stdout
 
-from .func_tools import call_my_function, get_table_list
+from .batch import DEFAULT_CONCURRENCY
+from .catalog import SchemaCatalog
+from .question_cache import QuestionCache, DEFAULT_MAX_QUESTIONS, is_follow_up
+from .schema_index import SchemaIndex, DEFAULT_TOP_K
+from .tracing import tracer
+from .utils import StepPrinter, write_atomic
 
 ASSISTANT_NAME="GPTSQL"
 GPT_MODEL3="gpt-3.5-turbo-1106"
@@ -26,6 +33,24 @@ GPT_MODEL=GPT_MODEL4
 POSTGRES_DEFAULT_PORT = 5432
 SINGLESTORE_DEFAULT_PORT = 3306
 
+# Bounds for run polling when the client can't stream run events
+POLL_MIN_DELAY = 0.2
+POLL_MAX_DELAY = 2.0
+
+# How many tool calls from one requires_action batch run at once
+DEFAULT_MAX_PARALLEL_QUERIES = 4
+
+# Roll over to a new thread once the conversation is about this many tokens,
+# since every run re-reads the whole thread
+DEFAULT_CONTEXT_BUDGET = 16_000
+# Rough size of a token for budgeting
+CHARS_PER_TOKEN = 4
+# Any single tool output is cut down to this size
+MAX_TOOL_OUTPUT_BYTES = 8000
+# How many earlier questions are summarized into a new thread, and how long each can be
+MAX_FINDINGS = 8
+FINDING_CHARS = 400
+
 # Replace these with your specific database credentials
 
 class GPTSql:
@@ -58,13 +83,109 @@ class GPTSql:
                 }
             }
         },
+        {
+            "type": "function",
+            "function": {
+                "name": "get_query_results_page",
+                "description": "Read more rows from a previous run_sql_command result without re-running the query",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "result_id": {
+                            "type": "string",
+                            "description": "The result_id reported with the query results. Defaults to the latest result"
+                        },
+                        "start_row": {
+                            "type": "integer",
+                            "description": "Zero-based index of the first row to return"
+                        },
+                        "num_rows": {
+                            "type": "integer",
+                            "description": "Number of rows to return"
+                        }
+                    },
+                    "required": ["start_row"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "profile_table",
+                "description": "Summarize every column of a table (null share, distinct count, min/max, quantiles, "
+                               "histogram, top values) over all its rows. Use this instead of reading sample rows "
+                               "when asked what a table looks like",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "table": {
+                            "type": "string",
+                            "description": "Table name, optionally schema qualified"
+                        }
+                    },
+                    "required": ["table"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "profile_query",
+                "description": "Summarize every column of a SELECT query's result like profile_table, without returning rows",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "SingleStore/Postgres syntax SELECT query"
+                        }
+                    },
+                    "required": ["query"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "query_stored_results",
+                "description": "Run SQL over results already fetched by earlier queries, without touching the database. "
+                               "Use it for follow-ups that filter, regroup, sort or join previous results. Each stored result "
+                               "is a table named by its result_id (r1, r2, ...); last_result is the newest one. Results that were cut "
+                               "off at the row budget hold just the rows kept and are listed under partial_sources",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "SQL query (SQLite/DuckDB syntax) over the stored result tables"
+                        }
+                    },
+                    "required": ["query"]
+                }
+            }
+        },
     ]
     CONFIG_FILE = os.path.expanduser('~/.gptsql')
+    # Conversation state changes every turn, so it lives apart from the credentials
+    STATE_FILE = os.path.expanduser('~/.gptsql_state')
+    STATE_KEYS = ["thread_id", "last_run_id", "last_message_id", "last_messsage_time"]
 
     def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.timings = []
         self.load_config()
+        self.load_state()
 
         args = self.parse_args()
+        self.args = args
+        self.show_timings = args.timings
+        self.batch = args.command == "batch"
+
+        self.max_parallel_queries = int(self.config.get("max_parallel_queries", DEFAULT_MAX_PARALLEL_QUERIES))
+        # In batch mode several turns share the pool
+        self.concurrent_turns = args.concurrency if self.batch else 1
+        self.db = None
+        self._engine_lock = threading.Lock()
 
         if 'DBUSER' in self.config and 'DBHOST' in self.config:
             db_type = self.config['DBTYPE']
@@ -98,19 +219,20 @@ class GPTSql:
                 db_port = prompt("Enter your database port ({}): ".format(default_port)) or default_port
                 db_port = int(db_port)
                 print("Validating connection info...")
+                from sqlalchemy import exc
+                from .connections import database_url
+
+                # Validate through the same pool the session will use, so the
+                # connection opened here is reused for the first query
+                db = self.connection_manager(database_url(db_type, db_username, db_password, db_host, db_port, db_name))
                 try:
-                    if db_type == 'PostgreSQL':
-                        conn = psycopg2.connect(
-                            f"host={db_host} dbname={db_name} user={db_username} password={db_password}",
-                            connect_timeout=10
-                        )
-                    else:
-                        conn = s2.connect(host=db_host, user=db_username, password=db_password, port=db_port)
-                    with conn.cursor() as cursor:
-                        cursor.execute("SELECT version();")
+                    db.validate()
                     connection_good = True
-                except (s2.OperationalError, psycopg2.OperationalError) as e:
+                    self.db = db
+                except (exc.SQLAlchemyError, ImportError) as e:
+                    # Bad credentials or host, or a missing database driver
                     print("Error: ", e)
+                    db.dispose()
                     continue
                 self.config |= {
                     "DBUSER": db_username,
@@ -132,20 +254,16 @@ class GPTSql:
             'db_name': db_name,
             'db_type': db_type
         }
-        if db_type == 'PostgreSQL':
-            self.connection_string = f'postgresql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}'
-        else:
-            self.connection_string = f'mysql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}'
-
-        self.engine = create_engine(self.connection_string)
-        # Connect to your database
-        if db_type == 'PostgreSQL':
-            self.conn = psycopg2.connect(
-                f"host={db_host} dbname={db_name} user={db_username} password={db_password}"
-            )
-        else:
-            self.conn = s2.connect(host=db_host, user=db_username, password=db_password, port=db_port, database=db_name)
+
+        self.catalog = None
+        self.question_cache = None
+        self.turn_queries = []
+        self.turn_used_stored_results = False
+        self.last_schema_slice = None
+        self.context_budget = int(self.config.get("context_budget_tokens", DEFAULT_CONTEXT_BUDGET))
         self.thread = None
+        self.setup_threads = {}
+        self.setup_errors = {}
 
         api_key = self.config.get('OPENAI_API_KEY') or os.environ.get('OPENAI_API_KEY')
         if api_key is None:
@@ -162,8 +280,118 @@ class GPTSql:
             else:
                 self.save_config("model", GPT_MODEL4)
 
-        self.oaclient = OpenAI(api_key=api_key)
+        self.api_key = api_key
+        self.mark("config")
+
+        # Database and OpenAI setup both involve network round trips, so run them
+        # in the background while the user types their first question
+        self.run_in_background("database", self.setup_database)
+        self.run_in_background("assistant", self.setup_assistant)
+
+    @property
+    def engine(self):
+        with self._engine_lock:
+            if self.db is None:
+                from .connections import database_url
+
+                c = self.db_config
+                self.db = self.connection_manager(database_url(
+                    c['db_type'], c['db_username'], c['db_password'], c['db_host'], c['db_port'], c['db_name']
+                ))
+        return self.db.engine
+
+    def connection_manager(self, url):
+        from .connections import ConnectionManager, POOL_RECYCLE
+
+        # One pooled connection per parallel tool call, plus one per turn for
+        # the streamed result kept around for "print all results"
+        return ConnectionManager(
+            url,
+            pool_size=int(self.config.get("pool_size", self.max_parallel_queries + self.concurrent_turns)),
+            max_overflow=self.max_parallel_queries * self.concurrent_turns,
+            read_only=self.config.get("read_only", True),
+            pool_recycle=int(self.config.get("pool_recycle", POOL_RECYCLE)),
+        )
+
+    def mark(self, phase):
+        self.timings.append((phase, time.perf_counter() - self.started_at))
+
+    def run_in_background(self, name, func):
+        def run():
+            try:
+                func()
+            except Exception as e:
+                self.setup_errors[name] = e
+            finally:
+                self.mark(name + " ready")
+
+        thread = threading.Thread(target=run, name=f"gptsql-{name}", daemon=True)
+        self.setup_threads[name] = thread
+        thread.start()
+
+    def wait_for(self, name):
+        self.setup_threads[name].join()
+        if name in self.setup_errors:
+            raise self.setup_errors[name]
+
+    def print_timings(self):
+        for phase, elapsed in self.timings:
+            print(f"  {phase:<20} {elapsed * 1000:8.1f} ms")
+
+    def setup_database(self):
+        # Importing func_tools also pulls in pandas, so the first query doesn't pay for it
+        from . import func_tools
+
+        if self.config.get("result_cache_dir"):
+            func_tools.result_cache.persist_dir = os.path.expanduser(self.config["result_cache_dir"])
+        func_tools.RESULT_FORMAT = self.config.get("result_format", func_tools.RESULT_FORMAT)
+        func_tools.RESULT_MAX_BYTES = int(self.config.get("result_max_bytes", func_tools.RESULT_MAX_BYTES))
+        for key in ["fetch_chunk_rows", "max_result_rows", "max_result_bytes"]:
+            if key in self.config:
+                setattr(func_tools, key.upper(), int(self.config[key]))
+        for key in ["max_query_cost", "max_estimated_rows", "explain_queries", "auto_limit", "statement_timeout"]:
+            if key in self.config:
+                setattr(func_tools.query_guard, key.upper(), self.config[key])
+        self.mark("database imports")
+
+        # Use the saved catalog straight away and bring it up to date in the background.
+        # Only a first run against a database has to wait for introspection.
+        schema = "public" if self.db_config["db_type"] == "PostgreSQL" else self.db_config["db_name"]
+        catalog = SchemaCatalog(self.engine, self.db_config["db_type"], self.config.get("DBSCHEMA", schema))
+        catalog.load()
+        catalog.refresh_in_background()
+        self.schema_index = SchemaIndex(catalog, top_k=int(self.config.get("schema_top_k", DEFAULT_TOP_K)))
+        if self.config.get("question_cache", True):
+            question_cache = QuestionCache(max_entries=int(self.config.get("question_cache_size", DEFAULT_MAX_QUESTIONS)))
+            question_cache.load()
+            self.question_cache = question_cache
+        self.catalog = catalog
+
+    def setup_assistant(self):
+        import openai
+
+        # OPENAI_BASE_URL lets us point at a local stand-in for the Assistants API
+        base_url = self.config.get('OPENAI_BASE_URL') or os.environ.get('OPENAI_BASE_URL')
+        self.oaclient = openai.OpenAI(api_key=self.api_key, base_url=base_url)
+        # Runs are driven with the async client; the sync one covers setup and reading messages back
+        self.async_oaclient = openai.AsyncOpenAI(api_key=self.api_key, base_url=base_url)
         self.get_or_create_assistant()
+        if self.batch:
+            # Every batch question gets a fresh thread
+            return
+
+        if self.state.get("thread_id") is not None:
+            self.thread = self.oaclient.beta.threads.retrieve(self.state["thread_id"])
+        else:
+            self.start_thread()
+            self.flush_state()
+
+        if self.state.get("last_run_id") is not None:
+            try:
+                self.oaclient.beta.threads.runs.cancel(thread_id=self.thread.id, run_id=self.state["last_run_id"])
+            except(openai.BadRequestError, openai.NotFoundError) as e:
+                print("Error4: ", e)
+                pass
 
     def parse_args(self):
         parser = argparse.ArgumentParser(add_help=False)
@@ -175,6 +403,16 @@ class GPTSql:
         parser.add_argument('-U', '--username', type=str, required=False)
         parser.add_argument('-d', '--dbname', type=str, required=False)
         parser.add_argument('--password', type=str, required=False)
+        parser.add_argument('--timings', action='store_true', help='Print a startup timing breakdown')
+
+        parser.add_argument('command', nargs='?', choices=['chat', 'batch'], default='chat',
+                            help='chat (default) or batch to answer a file of questions')
+        parser.add_argument('questions', nargs='?', default='-',
+                            help='batch: file with one question per line, or JSON lines (default: stdin)')
+        parser.add_argument('-o', '--output', type=str, required=False,
+                            help='batch: write JSON lines here instead of stdout')
+        parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                            help='batch: how many questions to run at once')
 
         return parser.parse_args()
     
@@ -186,8 +424,41 @@ class GPTSql:
             if isinstance(v, datetime):
                 self.config[k] = v.isoformat()
 
-        with open(self.CONFIG_FILE, 'w') as f:
-            f.write(json.dumps(self.config))
+        self.write_json(self.CONFIG_FILE, self.config)
+
+    def write_json(self, path, data):
+        write_atomic(path, json.dumps(data))
+
+    def load_state(self):
+        self.state = {}
+        self.state_dirty = False
+        self.state_lock = threading.Lock()
+        if os.path.exists(self.STATE_FILE):
+            with open(self.STATE_FILE, 'r') as f:
+                self.state = json.loads(f.read())
+        # Older versions kept the session state in the config file
+        moved = {k: self.config.pop(k) for k in self.STATE_KEYS if k in self.config}
+        if moved:
+            for k, v in moved.items():
+                self.state.setdefault(k, v)
+            self.state_dirty = True
+            self.flush_state()
+            self.save_config()
+
+    def set_state(self, key, value):
+        # Only marks the state as changed; flush_state() writes it once per turn
+        with self.state_lock:
+            if self.state.get(key) != value:
+                self.state[key] = value
+                self.state_dirty = True
+
+    def flush_state(self):
+        with self.state_lock:
+            if not self.state_dirty:
+                return
+            self.state_dirty = False
+            data = dict(self.state)
+        self.write_json(self.STATE_FILE, data)
 
     def load_config(self):
         self.config = {}
@@ -205,6 +476,8 @@ class GPTSql:
                 pass
 
     def get_version(self):
+        import toml
+
         try:
             pyproject = toml.load(os.path.join(os.path.dirname(__file__), "..", "pyproject.toml"))
             return pyproject["tool"]["poetry"]["version"]
@@ -213,6 +486,8 @@ class GPTSql:
             return importlib.metadata.version("gptsql")
 
     def get_or_create_assistant(self):
+        import openai
+
         # Create or retriveve our Assistant. We also upload the schema file
         # for RAG uses by the assistant.
         self.assistant = None
@@ -223,6 +498,15 @@ class GPTSql:
                 print("Assistant not found: ", e)
                 pass
 
+        if self.assistant is not None:
+            # Assistants created by older versions won't know about newer functions
+            known = {t.function.name for t in self.assistant.tools if t.type == "function"}
+            if known != {t["function"]["name"] for t in self.FUNCTION_TOOLS}:
+                self.assistant = self.oaclient.beta.assistants.update(
+                    self.assistant.id,
+                    tools=[{"type": "code_interpreter"}] + self.FUNCTION_TOOLS
+                )
+
         if self.assistant is None:
             print("Creating your PSQL assistant")
             self.assistant = self.oaclient.beta.assistants.create(
@@ -237,28 +521,15 @@ You are an assistant helping with data analysis and to query a postgres/singlest
             self.save_config("assistant_id", self.assistant.id)
 
     def chat_loop(self):
-        session = PromptSession(history=FileHistory(os.path.expanduser('~/.myhistory')))
+        asyncio.run(self.chat_loop_async())
 
-        if self.config.get("thread_id") is not None:
-            thread = self.oaclient.beta.threads.retrieve(self.config["thread_id"])
-        else:
-            thread = self.oaclient.beta.threads.create()
-            self.save_config("thread_id", thread.id)
-
-        self.thread = thread
-
-        if self.config.get("last_run_id") is not None:
-            try:
-                self.oaclient.beta.threads.runs.cancel(thread_id=thread.id, run_id=self.config["last_run_id"])
-            except(openai.BadRequestError, openai.NotFoundError) as e:
-                print("Error4: ", e)
-                pass
-            
-        self.last_message_created_at = self.config.get('last_messsage_time')
-        self.table_list = get_table_list(self.engine, self.db_config.get("db_name"))
-
-        spinner = Halo(text='thinking', spinner='dots')
-        self.spinner = spinner
+    async def chat_loop_async(self):
+        # The prompt stays live while a turn runs: output is printed above it, the
+        # turn's SQL runs in worker threads, and "cancel" or ctrl-c stops the turn
+        session = PromptSession(history=FileHistory(os.path.expanduser('~/.myhistory')))
+        self.spinner = StepPrinter()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_parallel_queries, thread_name_prefix="gptsql-sql")
+        self.turn_task = None
 
         print("""
 Welcome to GPTSQL, the chat interface to your SingleStore/Postgres database.
@@ -268,124 +539,518 @@ You can ask questions like:
     "show me the first 10 rows of the users table"
     "show me the schema for the orders table"
         """)
-        while True:
-            try:
-                cmd = session.prompt("\n> ")
+        self.mark("prompt ready")
+        if self.show_timings:
+            self.print_timings()
+        with patch_stdout():
+            while True:
+                try:
+                    cmd = await session.prompt_async("\n> ")
+                except KeyboardInterrupt:
+                    if self.turn_running():
+                        self.turn_task.cancel()
+                        continue
+                    break
+                except EOFError:
+                    break
                 if cmd == "":
                     continue
-                elif cmd == "history":
-                    self.display_messages(show_all=True)
+                elif cmd == "cancel":
+                    if self.turn_running():
+                        self.turn_task.cancel()
+                    continue
+                try:
+                    handled = await self.run_system_command(session, cmd)
+                except Exception as e:
+                    print("Error: ", e)
+                    continue
+                if handled == "exit":
+                    break
+                elif handled:
                     continue
-                elif cmd == "help":
-                    print("""
+
+                if self.turn_running():
+                    print("Still answering the last question (type 'cancel' to stop it)")
+                    continue
+                self.turn_task = asyncio.create_task(self.run_turn(cmd))
+
+        if self.turn_running():
+            self.turn_task.cancel()
+            await asyncio.gather(self.turn_task, return_exceptions=True)
+        self.flush_state()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def turn_running(self):
+        return self.turn_task is not None and not self.turn_task.done()
+
+    async def run_system_command(self, session, cmd):
+        # Returns True if cmd was a system command, "exit" to leave, False for a question
+        if cmd == "history":
+            await asyncio.to_thread(self.wait_for, "assistant")
+            await asyncio.to_thread(self.display_messages, True)
+        elif cmd == "help":
+            print("""
 connection - show the database connection info
 history - show the complete message history
+cache - show query result cache statistics
+pool - show database connection pool statistics
+clear cache [table] - drop cached results (only those reading from table, if given)
+questions - list remembered questions that are answered without the model
+clear questions - forget all remembered questions
+!<question> - ask the model even if the question was answered before
+cancel (or ctrl-c) - stop the question being answered
+refresh schema - reload the schema catalog from the database
+results - list the stored query results
+next page / prev page - page through the last printed results
+rows <start>-<end> [result id] - print a range of rows from stored results
 new thread - start a new thread
+context - show how much of the thread's context budget is used
+timings - show the startup timing breakdown
+stats - show timings and counters for recent turns and the session
+stats export <file> - write spans as a Chrome trace (.json) or JSON-lines (any other name)
 exit
-                          """)
-                    continue
-                elif cmd == "new thread":
-                    if session.prompt("Do you want to start a new thread (y/n)? ") == "y":
-                        thread = self.oaclient.beta.threads.create()
-                        self.save_config("thread_id", thread.id)
-                        self.thread = thread
-                    continue
-                elif cmd == "connection":
-                    print(f"Host: {self.db_config['db_host']}, Database: {self.db_config['db_name']}, User: {self.db_config['db_username']}")
-                    print(f"Model: {self.assistant.model}")
-                    print(f"Version: {self.get_version()}")
-                    continue
-                elif cmd == "exit":
+                      """)
+        elif cmd == "new thread":
+            if self.turn_running():
+                print("Wait for the current question to finish, or cancel it first")
+            elif await session.prompt_async("Do you want to start a new thread (y/n)? ") == "y":
+                await asyncio.to_thread(self.wait_for, "assistant")
+                await asyncio.to_thread(self.start_thread)
+                self.set_state("findings", [])
+                self.flush_state()
+        elif cmd == "context":
+            print(f"Thread {self.state.get('thread_id')}: ~{self.state.get('thread_tokens', 0):,} "
+                  f"of {self.context_budget:,} tokens, {len(self.state.get('findings', []))} findings to carry over")
+        elif cmd == "connection":
+            print(f"Host: {self.db_config['db_host']}, Database: {self.db_config['db_name']}, User: {self.db_config['db_username']}")
+            await asyncio.to_thread(self.wait_for, "assistant")
+            print(f"Model: {self.assistant.model}")
+            print(f"Version: {self.get_version()}")
+        elif cmd == "stats":
+            print(tracer.report())
+        elif cmd.startswith("stats export"):
+            path = cmd[len("stats export"):].strip() or "gptsql-trace.json"
+            tracer.export(path)
+            print(f"Wrote {path}")
+        elif cmd == "timings":
+            self.print_timings()
+        elif cmd == "pool":
+            await asyncio.to_thread(self.wait_for, "database")
+            print(", ".join(f"{k}: {v}" for k, v in self.db.stats().items()))
+        elif cmd == "cache":
+            from .func_tools import result_cache
+            print(", ".join(f"{k}: {v}" for k, v in result_cache.stats().items()))
+        elif cmd.startswith("clear cache"):
+            from .func_tools import result_cache
+            table = cmd[len("clear cache"):].strip()
+            result_cache.invalidate(table or None)
+        elif cmd == "results":
+            from .func_tools import result_store
+            for result in result_store.results.values():
+                more = "+" if result.more_rows else ""
+                print(f"{result.id}: {result.row_count}{more} rows  {result.query}")
+        elif cmd in ["next page", "prev page"]:
+            from .func_tools import page_cursor, print_results_page, PAGE_ROWS
+            start = page_cursor["start"]
+            if cmd == "prev page":
+                start = max(0, start - 2 * PAGE_ROWS)
+            # Paging past the fetched rows reads from the database
+            await asyncio.to_thread(print_results_page, page_cursor["id"], start)
+        elif re.match(r"rows \d+-\d+", cmd):
+            from .func_tools import print_results_page
+            m = re.match(r"rows (\d+)-(\d+)\s*(\S+)?", cmd)
+            start, end = int(m.group(1)), int(m.group(2))
+            await asyncio.to_thread(print_results_page, m.group(3), start, max(1, end - start + 1))
+        elif cmd == "questions":
+            await asyncio.to_thread(self.wait_for, "database")
+            if self.question_cache is not None:
+                for entry in self.question_cache.entries.values():
+                    print(f"{entry['hits']:>4} hits  {entry['question']}")
+                print(", ".join(f"{k}: {v}" for k, v in self.question_cache.stats().items()))
+        elif cmd == "clear questions":
+            await asyncio.to_thread(self.wait_for, "database")
+            if self.question_cache is not None:
+                self.question_cache.forget()
+        elif cmd == "refresh schema":
+            await asyncio.to_thread(self.wait_for, "database")
+            await asyncio.to_thread(self.catalog.refresh, True)
+            print(f"Loaded {len(self.catalog.table_names())} tables")
+        elif cmd == "exit":
+            return "exit"
+        else:
+            return False
+        return True
+
+    async def run_turn(self, cmd):
+        # A leading ! skips the remembered answer and asks the model
+        ask_model = cmd.startswith("!")
+        question = cmd.lstrip("!").strip()
+        tracer.start_turn(question)
+        asked, answers = False, []
+        try:
+            await asyncio.to_thread(self.wait_for, "database")
+            await asyncio.to_thread(self.catalog.wait)
+            if self.question_cache is not None and not ask_model:
+                entry = self.question_cache.get(question, self.catalog.fingerprint)
+                if entry is not None and await asyncio.to_thread(self.replay_answer, question, entry):
                     return
+            with tracer.span("schema_slice"):
+                schema_slice = self.schema_index.schema_slice(question)
+                cmd = schema_slice + "\n----\n" + question
+            print(cmd)
+            await asyncio.to_thread(self.wait_for, "assistant")
+            await asyncio.to_thread(self.ensure_context_budget, schema_slice)
+            self.last_schema_slice = schema_slice
+            # A follow-up ("and last month?") means something different without the
+            # turns before it, so only questions that stand on their own are remembered
+            self_contained = not is_follow_up(question)
+            self.turn_queries = []
+            self.turn_used_stored_results = False
+            asked = True
+            answers = await self.process_command_async(self.thread, cmd)
+            if not answers:
+                answers = await asyncio.to_thread(self.display_messages)
+            if self.turn_used_stored_results:
+                # The answer came from earlier results, which replaying the last query can't rebuild
+                self_contained = False
+            if self.question_cache is not None and self_contained and self.turn_queries and answers:
+                # The last query is the one that answered the question; earlier
+                # ones are usually the model looking around the schema
+                self.question_cache.put(question, self.catalog.fingerprint, self.turn_queries[-1], "\n".join(answers))
+            self.record_turn(question, answers)
+        except asyncio.CancelledError:
+            await self.cancel_turn()
+            print("Cancelled")
+        except Exception as e:
+            print("Error5: ", e)
+        finally:
+            if asked:
+                # Failed and cancelled turns still grew the thread
+                self.count_thread_tokens(question, answers)
+            self.flush_state()
+            tracer.end_turn()
 
-                cmd = "These are the tables in the database:\n" + ",".join(self.table_list) + "\n----\n" + cmd
-                print(cmd)
-                spinner.start("thinking...")
-                self.process_command(thread, cmd)
-                spinner.stop()
-                self.display_messages()
-            except (KeyboardInterrupt, EOFError) as e:
-                print("Error5: ", e)
-                spinner.stop()
-                return
+    async def cancel_turn(self):
+        import openai
+
+        tracer.count("turns_cancelled")
+        # run_tool_calls has already stopped any SQL it was waiting on; stop the run itself
+        run_id = self.state.get("last_run_id")
+        if run_id is not None:
+            try:
+                with tracer.api_call("runs.cancel"):
+                    await self.async_oaclient.beta.threads.runs.cancel(thread_id=self.thread.id, run_id=run_id)
+            except openai.OpenAIError as e:
+                print("Error4: ", e)
+
+    def run_batch(self):
+        from .batch import BatchRunner, read_questions
+        from .func_tools import result_store
+
+        questions = read_questions(self.args.questions)
+        out = open(self.args.output, 'w') if self.args.output else sys.stdout
+        self.spinner = StepPrinter(quiet=True)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_parallel_queries * self.concurrent_turns, thread_name_prefix="gptsql-sql"
+        )
+        # Keep enough results around for every question in flight to page its own
+        result_store.keep = max(result_store.keep, 2 * self.concurrent_turns)
+        # Query echo and other progress output goes to stderr so stdout is pure JSON lines.
+        # Batch threads are throwaway, so the chat session state is never written.
+        with redirect_stdout(sys.stderr):
+            self.wait_for("database")
+            self.catalog.wait()
+            self.wait_for("assistant")
+            runner = BatchRunner(self, out, concurrency=self.concurrent_turns)
+            summary = runner.run(questions)
+            print(json.dumps(summary))
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if out is not sys.stdout:
+            out.close()
+
+    def start_thread(self, seed=None):
+        with tracer.api_call("threads.create"):
+            self.thread = self.oaclient.beta.threads.create()
+        self.set_state("thread_id", self.thread.id)
+        self.set_state("last_message_id", None)
+        self.set_state("thread_tokens", 0)
+        if seed:
+            with tracer.api_call("messages.create"):
+                message = self.oaclient.beta.threads.messages.create(thread_id=self.thread.id, role="user", content=seed)
+            # Don't print the seed back as if it were part of this conversation
+            self.set_state("last_message_id", message.id)
+            self.set_state("thread_tokens", len(seed) // CHARS_PER_TOKEN)
+
+    def ensure_context_budget(self, schema_slice=None):
+        # Every run makes the model re-read the whole thread, so once it gets large we
+        # carry a short summary over to a fresh thread instead of letting it grow
+        if self.state.get("thread_tokens", 0) <= self.context_budget:
+            return
+        findings = self.state.get("findings", [])
+        lines = ["Summary of our earlier conversation (continued in a new thread to keep it short):"]
+        for finding in findings:
+            lines.append(f"- Q: {finding['question']}")
+            if finding.get("sql"):
+                lines.append(f"  SQL: {finding['sql']}")
+            lines.append(f"  A: {finding['answer']}")
+        # The slice the earlier turns were answered with; the next message brings its own
+        if self.last_schema_slice and self.last_schema_slice != schema_slice:
+            lines += ["", self.last_schema_slice]
+        tracer.count("thread_rollovers")
+        self.log("starting a new thread...")
+        self.start_thread("\n".join(lines) if findings else None)
+
+    def count_thread_tokens(self, question, answers):
+        tracer_turn = tracer.turn
+        sent = tracer_turn["counters"]["bytes_sent"] if tracer_turn else len(question)
+        received = sum(len(a) for a in answers)
+        self.set_state("thread_tokens", self.state.get("thread_tokens", 0) + (sent + received) // CHARS_PER_TOKEN)
+
+    def record_turn(self, question, answers):
+        if answers:
+            answer = " ".join(answers)
+            finding = {
+                "question": question[:FINDING_CHARS],
+                "sql": self.turn_queries[-1][:FINDING_CHARS] if self.turn_queries else None,
+                "answer": answer if len(answer) <= FINDING_CHARS else answer[:FINDING_CHARS - 1] + "…",
+            }
+            self.set_state("findings", (self.state.get("findings", []) + [finding])[-MAX_FINDINGS:])
+
+    def replay_answer(self, question, entry):
+        # Run the remembered SQL again for fresh data, without a model round trip
+        from .func_tools import call_my_function, print_results_page
+
+        tracer.count("question_cache_hits")
+        print("[cached] Re-running the query that answered this before (prefix with ! to ask the model)")
+        output = call_my_function(self.engine, "run_sql_command", {"query": entry["sql"]}, self.thread.id)
+        if isinstance(output, dict) and "error" in output:
+            self.question_cache.forget(question)
+            return False
+        print_results_page(scope=self.thread.id)
+        print(f"[previous answer] --> {entry['answer']}")
+        return True
 
     def display_messages(self, show_all=False):
-            messages = self.oaclient.beta.threads.messages.list(
-                thread_id=self.thread.id
-            )
-            for msg in reversed(list(messages)):
+        # Only page through messages newer than the last one we printed, oldest first.
+        # Returns the text of the assistant messages that were printed.
+        printed = []
+        with tracer.span("display_messages"):
+            after = None if show_all else self.state.get("last_message_id")
+            params = {"thread_id": self.thread.id, "order": "asc"}
+            if after is not None:
+                params["after"] = after
+            with tracer.api_call("messages.list"):
+                messages = list(self.oaclient.beta.threads.messages.list(**params))
+            # Sessions saved before the message cursor existed only have a timestamp
+            last_time = self.state.get("last_messsage_time") if after is None and not show_all else None
+            for msg in messages:
+                if not show_all:
+                    self.set_state("last_message_id", msg.id)
                 if msg.role == "user" and not show_all:
                     continue
-                if self.last_message_created_at is None or (msg.created_at > self.last_message_created_at) or show_all:
-                    self.last_message_created_at = msg.created_at
-                    self.save_config("last_messsage_time", self.last_message_created_at)
-                    if hasattr(msg.content[0], 'text'):
-                        print(f"[{msg.role}] --> {msg.content[0].text.value}")
-                    else:
-                        print(f"[{msg.role}] --> {type(msg)}")
+                if last_time is not None and msg.created_at <= last_time:
+                    continue
+                if hasattr(msg.content[0], 'text'):
+                    print(f"[{msg.role}] --> {msg.content[0].text.value}")
+                    if msg.role == "assistant":
+                        printed.append(msg.content[0].text.value)
+                else:
+                    print(f"[{msg.role}] --> {type(msg)}")
+        return printed
 
     def log(self, msg):
         self.spinner.start(msg);
         #print(msg)
     
-    def process_command(self, thread, cmd: str):
-        self.oaclient.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=cmd
-        )
-        runobj = self.oaclient.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=self.assistant.id
-        )
-        self.save_config("last_run_id", runobj.id)
+    def process_command(self, thread, cmd: str, echo=True):
+        # For callers without an event loop (the benchmarks). The chat loop and batch
+        # mode await process_command_async on their own loop.
+        return asyncio.run(self.process_command_async(thread, cmd, echo))
+
+    async def process_command_async(self, thread, cmd: str, echo=True):
+        # Ask `cmd` on `thread` and drive the run to completion. Answer text is printed
+        # as it streams in if `echo` is set, and the answers are returned.
+        answers = []
+        client = self.async_oaclient
+        with tracer.span("process_command"):
+            tracer.count("bytes_sent", len(cmd.encode()))
+            with tracer.api_call("messages.create"):
+                await client.beta.threads.messages.create(
+                    thread_id=thread.id,
+                    role="user",
+                    content=cmd
+                )
+            try:
+                with tracer.api_call("runs.create"):
+                    stream = await client.beta.threads.runs.create(
+                        thread_id=thread.id,
+                        assistant_id=self.assistant.id,
+                        stream=True
+                    )
+            except TypeError:
+                # Client too old to stream run events, fall back to polling
+                with tracer.api_call("runs.create"):
+                    runobj = await client.beta.threads.runs.create(
+                        thread_id=thread.id,
+                        assistant_id=self.assistant.id
+                    )
+                await self.poll_run(thread, runobj)
+                return answers
+
+            while stream is not None:
+                with tracer.span("run.stream"):
+                    stream = await self.consume_run_events(thread, stream, answers, echo)
+        return answers
+
+    async def consume_run_events(self, thread, stream, answers, echo=True):
+        # Handle events from a streamed run. Returns the stream that continues the
+        # run after we submit tool outputs, or None once the run has finished.
+        partial = []
+        async with stream:
+            async for event in stream:
+                if event.event == "thread.run.created":
+                    self.set_state("last_run_id", event.data.id)
+                elif event.event == "thread.run.step.completed":
+                    self.log_step(event.data)
+                elif event.event == "thread.message.delta":
+                    for part in event.data.delta.content or []:
+                        if part.type == "text" and part.text is not None and part.text.value:
+                            if echo and not partial:
+                                print("[assistant] --> ", end="", flush=True)
+                            partial.append(part.text.value)
+                            if echo:
+                                print(part.text.value, end="", flush=True)
+                elif event.event == "thread.message.completed":
+                    if partial:
+                        if echo:
+                            print()
+                        answers.append("".join(partial))
+                        partial = []
+                    self.set_state("last_message_id", event.data.id)
+                elif event.event == "thread.run.requires_action":
+                    runobj = event.data
+                    if runobj.required_action.type != "submit_tool_outputs":
+                        print("Unknown action: ", runobj.required_action.type)
+                        return None
+                    tool_outputs = await self.run_tool_calls(runobj, scope=thread.id)
+                    with tracer.api_call("runs.submit_tool_outputs"):
+                        return await self.async_oaclient.beta.threads.runs.submit_tool_outputs(
+                            thread_id=thread.id,
+                            run_id=runobj.id,
+                            tool_outputs=tool_outputs,
+                            stream=True
+                        )
+                elif event.event in ["thread.run.failed", "thread.run.expired"]:
+                    print(f"Run {event.data.status}: ", event.data.last_error)
+                elif event.event == "error":
+                    print("Error6: ", event.data)
+        return None
+
+    async def poll_run(self, thread, runobj):
+        # Poll with adaptive backoff: check quickly right after a state change,
+        # then back off while the run sits in the same state.
+        client = self.async_oaclient
+        self.set_state("last_run_id", runobj.id)
         last_step_count = 0
+        delay = POLL_MIN_DELAY
         while runobj.status not in ["completed", "expired", "cancelled", "failed"]:
             if runobj.status == "in_progress":
                 # check for new steps
-                run_steps = self.oaclient.beta.threads.runs.steps.list(
-                    thread_id=thread.id,
-                    run_id=runobj.id
-                )
-                run_steps = list(run_steps)
-                #print(run_steps)
-                #print("\n\n")
-                if len(run_steps) > last_step_count:
-                    for step in run_steps[last_step_count:]:
-                        for step_detail in step.step_details:
-                            if step_detail[0] == 'tool_calls':
-                                for tool_call in step_detail[1]:
-                                    #if 'Function' in str(type(tool_call)):
-                                    #    self.log(f"  --> {tool_call.function.name}()")
-                                    if 'Code' in str(type(tool_call)):
-                                        self.log(f"  [code] {tool_call.code_interpreter.input}")
+                with tracer.api_call("runs.steps.list"):
+                    run_steps = await client.beta.threads.runs.steps.list(
+                        thread_id=thread.id,
+                        run_id=runobj.id
+                    )
+                run_steps = list(getattr(run_steps, "data", run_steps))
+                for step in run_steps[last_step_count:]:
+                    self.log_step(step)
                 last_step_count = len(run_steps)
             elif runobj.status == "requires_action":
                 # Run any functions that the assistant has requested
                 if runobj.required_action.type == "submit_tool_outputs":
-                    tool_outputs = []
-                    for tool_call in runobj.required_action.submit_tool_outputs.tool_calls:
-                        self.log(f"  --> {tool_call.function.name}()")
-                        res = str(call_my_function(self.engine, tool_call.function.name, json.loads(tool_call.function.arguments)))
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": res
-                        })
-                    self.oaclient.beta.threads.runs.submit_tool_outputs(
-                        thread_id=thread.id,
-                        run_id=runobj.id,
-                        tool_outputs=tool_outputs
-                    )
-                    self.spinner.text = "considering results..."
+                    tool_outputs = await self.run_tool_calls(runobj, scope=thread.id)
+                    with tracer.api_call("runs.submit_tool_outputs"):
+                        runobj = await client.beta.threads.runs.submit_tool_outputs(
+                            thread_id=thread.id,
+                            run_id=runobj.id,
+                            tool_outputs=tool_outputs
+                        )
+                    delay = POLL_MIN_DELAY
+                    continue
                 else:
                     print("Unknown action: ", runobj.required_action.type)
-            time.sleep(1)
-            runobj = self.oaclient.beta.threads.runs.retrieve(thread_id=thread.id, run_id=runobj.id)
+            with tracer.span("run.poll_wait"):
+                await asyncio.sleep(delay)
+            last_status = runobj.status
+            with tracer.api_call("runs.retrieve"):
+                runobj = await client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=runobj.id)
+            delay = POLL_MIN_DELAY if runobj.status != last_status else min(delay * 2, POLL_MAX_DELAY)
+
+    def log_step(self, step):
+        for step_detail in step.step_details:
+            if step_detail[0] == 'tool_calls':
+                for tool_call in step_detail[1]:
+                    if 'Code' in str(type(tool_call)):
+                        self.log(f"  [code] {tool_call.code_interpreter.input}")
+
+    async def run_tool_calls(self, runobj, scope=None):
+        # Run the batch of tool calls concurrently in worker threads so the wait is the
+        # slowest query rather than the sum. Each call reports as soon as it finishes;
+        # outputs are returned in the original order. Stored results are scoped to the
+        # Assistants thread, so concurrent batch questions never see each other's.
+        loop = asyncio.get_running_loop()
+        tool_calls = runobj.required_action.submit_tool_outputs.tool_calls
+
+        async def run(tool_call):
+            self.log(f"  --> {tool_call.function.name}()")
+            start = time.perf_counter()
+            output = await loop.run_in_executor(self.executor, self.run_tool_call, tool_call, scope)
+            rows = re.search(r"^# rows: (.*)$", output, re.MULTILINE)
+            summary = f"{rows.group(1)} rows" if rows else f"{len(output):,} bytes"
+            self.log(f"  <-- {tool_call.function.name}: {summary} in {(time.perf_counter() - start) * 1000:.0f} ms")
+            return output
+
+        try:
+            outputs = await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+        except asyncio.CancelledError:
+            # Cancelling only stops our wait; stop the statements on the server too
+            from .query_guard import cancel_running
+            if await asyncio.to_thread(cancel_running):
+                print("Cancelled running queries")
+            raise
+        return [
+            {"tool_call_id": tool_call.id, "output": output}
+            for tool_call, output in zip(tool_calls, outputs)
+        ]
+
+    def run_tool_call(self, tool_call, scope=None):
+        from .func_tools import call_my_function
+
+        # A failing call reports its error to the model without sinking the batch
+        with tracer.span("tool." + tool_call.function.name):
+            try:
+                fargs = json.loads(tool_call.function.arguments)
+                result = call_my_function(self.engine, tool_call.function.name, fargs, scope)
+                if tool_call.function.name == "run_sql_command" and not (isinstance(result, dict) and "error" in result):
+                    self.turn_queries.append(fargs.get("query"))
+                elif tool_call.function.name == "query_stored_results":
+                    self.turn_used_stored_results = True
+                output = str(result)
+            except Exception as e:
+                output = str({"error": f"{tool_call.function.name} failed: {e}"})
+        if len(output) > MAX_TOOL_OUTPUT_BYTES:
+            output = output[:MAX_TOOL_OUTPUT_BYTES] + f"\n... [cut {len(output) - MAX_TOOL_OUTPUT_BYTES:,} more characters]"
+
+        tracer.count("bytes_sent", len(output.encode()))
+        return output
 
 
 def main():
     gptsql = GPTSql()
-    gptsql.chat_loop()
+    if gptsql.batch:
+        gptsql.run_batch()
+    else:
+        gptsql.chat_loop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+from .tracing import tracer
+
+# How many questions are in flight at once
+DEFAULT_CONCURRENCY = 8
+
+def read_questions(path):
+    """ Questions from `path` ("-" for stdin): one per line, or JSON lines with a "question"
+        and an optional "id". Blank lines and lines starting with # are skipped.
+    """
+    f = sys.stdin if path in [None, "-"] else open(path)
+    try:
+        questions = []
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                item = json.loads(line)
+                questions.append({"id": item.get("id"), "question": item["question"]})
+            else:
+                questions.append({"id": None, "question": line})
+        return questions
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+class BatchRunner:
+    """ Answers a list of questions, each on its own Assistants thread.
+
+        Up to `concurrency` questions run at once on one event loop, through the same
+        run driver as the chat loop. They share the app's connection pool, schema
+        index and result cache, so the wall time is bounded by the slowest questions
+        rather than the sum of them. Each answer is written to `out` as a JSON line as
+        soon as it is ready, so lines arrive out of order; use "index" to restore the
+        input order.
+    """
+    def __init__(self, app, out, concurrency=DEFAULT_CONCURRENCY):
+        self.app = app
+        self.out = out
+        self.concurrency = concurrency
+
+    def run(self, questions):
+        # Ctrl-c cancels the questions in flight, which also cancels their queries on the server
+        return asyncio.run(self.run_async(questions))
+
+    async def run_async(self, questions):
+        start = time.perf_counter()
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def run_one(index, item):
+            queued_at = time.perf_counter()
+            async with slots:
+                record = await self.answer(index, item, queued_at)
+            self.write(record)
+            return record
+
+        records = await asyncio.gather(*(run_one(index, item) for index, item in enumerate(questions)))
+        return self.summary(records, time.perf_counter() - start)
+
+    async def answer(self, index, item, queued_at):
+        app = self.app
+        client = app.async_oaclient
+        started = time.perf_counter()
+        record = {"index": index, "id": item["id"], "question": item["question"]}
+        try:
+            with tracer.span("batch.question", index=index):
+                with tracer.api_call("threads.create"):
+                    thread = await client.beta.threads.create()
+                record["thread_id"] = thread.id
+                with tracer.span("schema_slice"):
+                    prompt = app.schema_index.schema_slice(item["question"]) + "\n----\n" + item["question"]
+                answers = await app.process_command_async(thread, prompt, echo=False)
+                if not answers:
+                    # Polled runs don't report their messages as they go
+                    answers = await asyncio.to_thread(self.list_answers, thread)
+            answer = "\n".join(answers)
+            record |= {"status": "ok" if answer else "no_answer", "answer": answer}
+        except Exception as e:
+            record |= {"status": "error", "error": str(e)}
+        finished = time.perf_counter()
+        record["timings"] = {
+            "queued_ms": round((started - queued_at) * 1000, 1),
+            "elapsed_ms": round((finished - started) * 1000, 1),
+        }
+        return record
+
+    def list_answers(self, thread):
+        with tracer.api_call("messages.list"):
+            messages = list(self.app.oaclient.beta.threads.messages.list(thread_id=thread.id, order="asc"))
+        return [
+            msg.content[0].text.value for msg in messages
+            if msg.role == "assistant" and hasattr(msg.content[0], 'text')
+        ]
+
+    def write(self, record):
+        self.out.write(json.dumps(record, default=str) + "\n")
+        self.out.flush()
+
+    def summary(self, records, wall_s):
+        elapsed = sorted(r["timings"]["elapsed_ms"] for r in records)
+        statuses = {}
+        for r in records:
+            statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+        return {
+            "questions": len(records),
+            "statuses": statuses,
+            "wall_s": round(wall_s, 2),
+            "questions_per_min": round(len(records) / wall_s * 60, 1) if wall_s else None,
+            "median_question_ms": round(statistics.median(elapsed), 1) if elapsed else None,
+            "serial_estimate_s": round(sum(elapsed) / 1000, 2),
+        }
@@ -0,0 +1,225 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+from .tracing import tracer
+from .utils import write_atomic
+
+CATALOG_DIR = os.path.expanduser('~/.gptsql_catalog')
+# Re-check the database for DDL changes once the saved catalog is this old
+CATALOG_TTL = 6 * 3600
+
+# One row per (table, column) for the whole schema
+POSTGRES_CATALOG_SQL = """
+    SELECT c.relname, coalesce(obj_description(c.oid, 'pg_class'), ''),
+        c.reltuples::bigint, pg_total_relation_size(c.oid),
+        a.attname, format_type(a.atttypid, a.atttypmod), coalesce(col_description(c.oid, a.attnum), '')
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    WHERE n.nspname = '{schema}' AND c.relkind IN ('r', 'v', 'm', 'p', 'f') {tables_filter}
+    ORDER BY c.relname, a.attnum
+"""
+
+# One row per table with a hash of its column definitions, used to spot DDL changes,
+# and its current row estimate and size
+POSTGRES_SIGNATURE_SQL = """
+    SELECT c.relname, md5(string_agg(a.attname || ':' || format_type(a.atttypid, a.atttypmod), ',' ORDER BY a.attnum)),
+        c.reltuples::bigint, pg_total_relation_size(c.oid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    WHERE n.nspname = '{schema}' AND c.relkind IN ('r', 'v', 'm', 'p', 'f')
+    GROUP BY c.oid, c.relname, c.reltuples
+"""
+
+SINGLESTORE_CATALOG_SQL = """
+    SELECT c.table_name, coalesce(t.table_comment, ''), coalesce(t.table_rows, 0),
+        coalesce(t.data_length, 0) + coalesce(t.index_length, 0),
+        c.column_name, c.column_type, coalesce(c.column_comment, '')
+    FROM information_schema.columns c
+    JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+    WHERE c.table_schema = '{schema}' {tables_filter}
+    ORDER BY c.table_name, c.ordinal_position
+"""
+
+SINGLESTORE_SIGNATURE_SQL = """
+    SELECT c.table_name, md5(group_concat(concat(c.column_name, ':', c.column_type) ORDER BY c.ordinal_position SEPARATOR ',')),
+        coalesce(t.table_rows, 0), coalesce(t.data_length, 0) + coalesce(t.index_length, 0)
+    FROM information_schema.columns c
+    JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+    WHERE c.table_schema = '{schema}'
+    GROUP BY c.table_name, t.table_rows, t.data_length, t.index_length
+"""
+
+def quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+class SchemaCatalog:
+    """ Local copy of the tables, columns, types, row estimates and sizes in a schema.
+
+        The catalog is persisted under CATALOG_DIR, keyed by connection, so startup can
+        use it right away. `refresh()` compares per-table column signatures with the
+        database and only re-introspects the tables that changed; row estimates and
+        sizes come with the signatures, so they are brought up to date for every table.
+    """
+    def __init__(self, engine, db_type, schema, catalog_dir=None, ttl=CATALOG_TTL):
+        self.engine = engine
+        self.db_type = db_type
+        self.schema = schema
+        self.ttl = ttl
+        self.tables = {}
+        self.signatures = {}
+        self.refreshed_at = 0
+        # Bumped whenever the table definitions change
+        self.version = 0
+        self.lock = threading.RLock()
+        self.ready = threading.Event()
+        self._refresh_thread = None
+
+        key = engine.url.render_as_string(hide_password=True) + "/" + schema
+        self.path = os.path.join(catalog_dir or CATALOG_DIR, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    @property
+    def stale(self):
+        return time.time() - self.refreshed_at > self.ttl
+
+    def table_names(self):
+        with self.lock:
+            return sorted(self.tables)
+
+    def columns(self, table):
+        with self.lock:
+            return self.tables.get(table, {}).get("columns", [])
+
+    @property
+    def fingerprint(self):
+        """ Hash over all table signatures; changes whenever any table's columns do. """
+        with self.lock:
+            raw = ",".join(f"{t}:{sig}" for t, sig in sorted(self.signatures.items()))
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return False
+        with self.lock:
+            self.tables = data["tables"]
+            self.signatures = data["signatures"]
+            self.refreshed_at = data["refreshed_at"]
+            self.version += 1
+        self.ready.set()
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            data = json.dumps({
+                "tables": self.tables,
+                "signatures": self.signatures,
+                "refreshed_at": self.refreshed_at,
+            })
+        write_atomic(self.path, data)
+
+    def refresh(self, force=False):
+        """ Bring the catalog up to date, re-reading only tables whose columns changed. """
+        if not force and self.tables and not self.stale:
+            self.ready.set()
+            return
+        with tracer.span("catalog.refresh"):
+            self._refresh(force)
+
+    def _refresh(self, force):
+        signatures, sizes = self._fetch_signatures()
+        with self.lock:
+            changed = [t for t, sig in signatures.items() if force or self.signatures.get(t) != sig]
+            dropped = [t for t in self.tables if t not in signatures]
+        if changed:
+            # A full pass is cheaper than a long IN list once most tables changed
+            tables = self._introspect(None if len(changed) > len(signatures) // 2 else changed)
+        else:
+            tables = {}
+        with self.lock:
+            for t in dropped:
+                self.tables.pop(t, None)
+            self.tables.update(tables)
+            for t, (rows, size) in sizes.items():
+                if t in self.tables:
+                    self.tables[t]["rows"] = rows
+                    self.tables[t]["bytes"] = size
+            if tables or dropped:
+                self.version += 1
+            self.signatures = signatures
+            self.refreshed_at = time.time()
+        self.save()
+        self.ready.set()
+
+    def refresh_in_background(self, force=False):
+        def run():
+            try:
+                self.refresh(force=force)
+            except Exception as e:
+                print("Error refreshing schema catalog: ", e)
+            finally:
+                self.ready.set()
+
+        self._refresh_thread = threading.Thread(target=run, daemon=True)
+        self._refresh_thread.start()
+
+    def wait(self, timeout=None):
+        """ Block until the catalog has some content (from disk or the database). """
+        return self.ready.wait(timeout)
+
+    def _fetch_signatures(self):
+        """ Returns ({table: column signature}, {table: (row estimate, bytes)}). """
+        sql = POSTGRES_SIGNATURE_SQL if self.db_type == 'PostgreSQL' else SINGLESTORE_SIGNATURE_SQL
+        with self.engine.connect() as connection:
+            rows = connection.exec_driver_sql(sql.format(schema=self.schema.replace("'", "''"))).fetchall()
+        signatures = {r[0]: r[1] for r in rows}
+        sizes = {r[0]: (int(float(r[2] or 0)), int(float(r[3] or 0))) for r in rows}
+        return signatures, sizes
+
+    def _introspect(self, table_names=None):
+        if self.db_type == 'PostgreSQL':
+            sql, name_col = POSTGRES_CATALOG_SQL, "c.relname"
+        else:
+            sql, name_col = SINGLESTORE_CATALOG_SQL, "c.table_name"
+        tables_filter = ""
+        if table_names:
+            tables_filter = f"AND {name_col} IN ({','.join(quote_literal(t) for t in table_names)})"
+        sql = sql.format(schema=self.schema.replace("'", "''"), tables_filter=tables_filter)
+
+        tables = {}
+        for name, comment, rows, size, column, data_type, column_comment in self._fetch_rows(sql):
+            table = tables.setdefault(name, {
+                "comment": comment,
+                "rows": int(float(rows or 0)),
+                "bytes": int(float(size or 0)),
+                "columns": [],
+            })
+            table["columns"].append([column, data_type, column_comment])
+        return tables
+
+    def _fetch_rows(self, sql):
+        if self.engine.dialect.driver == 'psycopg2':
+            # COPY streams the whole result as one CSV payload, which is much
+            # faster than row-by-row fetching for large catalogs
+            raw = self.engine.raw_connection()
+            try:
+                buf = io.StringIO()
+                with raw.cursor() as cursor:
+                    cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH CSV", buf)
+                buf.seek(0)
+                return list(csv.reader(buf))
+            finally:
+                raw.close()
+        with self.engine.connect() as connection:
+            return [tuple(r) for r in connection.exec_driver_sql(sql)]
@@ -0,0 +1,158 @@
+from collections import Counter
+import threading
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import URL, make_url
+from termcolor import colored
+
+from .tracing import tracer
+
+# Pooled connections older than this are replaced, before a server or proxy idle timeout drops them
+POOL_RECYCLE = 1800
+CONNECT_TIMEOUT = 10
+# How many times a read-only statement is retried after its connection dropped
+DISCONNECT_RETRIES = 1
+
+# Run once on every new connection
+READ_ONLY_SQL = {
+    "postgresql": "SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY",
+    "mysql": "SET SESSION TRANSACTION READ ONLY",
+    "singlestoredb": "SET SESSION TRANSACTION READ ONLY",
+    "sqlite": "PRAGMA query_only = ON",
+}
+
+def database_url(db_type, username, password, host, port, database) -> URL:
+    # URL.create escapes credentials, so passwords may contain @, / or :.
+    # SingleStore goes through the singlestoredb driver's own SQLAlchemy dialect.
+    drivername = "postgresql+psycopg2" if db_type == "PostgreSQL" else "singlestoredb"
+    return URL.create(drivername, username=username, password=password, host=host, port=port, database=database)
+
+def retry_on_disconnect(func, retries=DISCONNECT_RETRIES):
+    """ Call `func`, and call it again if it failed because the database connection dropped.
+
+        Only use this for read-only work, which is safe to repeat. `func` must take a
+        fresh connection from the pool each time.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except exc.DBAPIError as e:
+            if not e.connection_invalidated or attempt == retries:
+                raise
+            tracer.count("db_reconnects")
+            print(colored("Lost the database connection, reconnecting...", "yellow"))
+
+class ConnectionManager:
+    """ The session's pooled database engine for Postgres and SingleStore.
+
+        Connections are checked with a ping on checkout, recycled before idle timeouts
+        and kept alive with TCP keepalives. Each new connection is switched to read-only
+        once, when it is opened. `stats()` reports the pool occupancy and connection
+        events for the session.
+    """
+    def __init__(self, url, pool_size=5, max_overflow=5, read_only=True,
+                 pool_recycle=POOL_RECYCLE, connect_timeout=CONNECT_TIMEOUT):
+        self.url = make_url(url)
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.read_only = read_only
+        self.pool_recycle = pool_recycle
+        self.connect_timeout = connect_timeout
+        self.counters = Counter()
+        self.warned = set()
+        self._engine = None
+        self.lock = threading.Lock()
+
+    @property
+    def engine(self):
+        with self.lock:
+            if self._engine is None:
+                self._engine = self._create_engine()
+        return self._engine
+
+    def _create_engine(self):
+        url, connect_args = self.url, self._connect_args()
+        if url.get_backend_name() == "singlestoredb" and url.password is not None:
+            # The singlestoredb dialect re-parses the URL as a string without escaping
+            # "/" in the password, so the password goes to the driver directly
+            connect_args["password"] = url.password
+            # URL.set ignores None, so the URL is rebuilt without the password
+            url = URL.create(
+                url.drivername, username=url.username, host=url.host, port=url.port,
+                database=url.database, query=url.query
+            )
+        engine = create_engine(
+            url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_pre_ping=True,
+            pool_recycle=self.pool_recycle,
+            connect_args=connect_args,
+        )
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", lambda *args: self._count("checkouts"))
+        event.listen(engine, "invalidate", lambda *args: self._count("invalidated"))
+        return engine
+
+    def _connect_args(self):
+        backend = self.url.get_backend_name()
+        if backend == "postgresql":
+            return {
+                "connect_timeout": self.connect_timeout,
+                "keepalives": 1,
+                "keepalives_idle": 60,
+                "keepalives_interval": 10,
+                "keepalives_count": 3,
+            }
+        if backend in ["mysql", "singlestoredb"]:
+            return {"connect_timeout": self.connect_timeout}
+        return {}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self._count("connects")
+        tracer.count("db_connects")
+        sql = READ_ONLY_SQL.get(self.url.get_backend_name()) if self.read_only else None
+        if sql is None:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(sql)
+        except Exception as e:
+            # Some servers don't support read-only sessions; the SELECT-only check still applies
+            if "read_only" not in self.warned:
+                self.warned.add("read_only")
+                print(colored(f"Could not make the database session read-only: {e}", "yellow"))
+        finally:
+            cursor.close()
+        # Commit so the setting outlives the pool's rollback on return
+        dbapi_connection.commit()
+
+    def validate(self):
+        """ Open (and keep in the pool) one connection, raising if the database can't be reached. """
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("SELECT 1")
+
+    def stats(self):
+        pool = self.engine.pool
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "connects": counters.get("connects", 0),
+            "checkouts": counters.get("checkouts", 0),
+            "invalidated": counters.get("invalidated", 0),
+            "reconnects": tracer.counters["db_reconnects"],
+        }
+
+    def dispose(self):
+        with self.lock:
+            if self._engine is not None:
+                self._engine.dispose()
+                self._engine = None
@@ -1,44 +1,530 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
 from termcolor import colored
 from tabulate import tabulate
 import pandas as pd
-from sqlalchemy import text
 
-last_results: pd.DataFrame = None
+from . import local_query, query_guard, serialize, table_profile
+from .connections import retry_on_disconnect
+from .result_store import ResultStore
+from .tracing import tracer
+
+# Number of rows sent back to the model for a query
+PREVIEW_ROWS = 20
+# Rows pulled from the server-side cursor per round trip
+FETCH_CHUNK_ROWS = 1000
+# Upper bounds on how much of a result we keep locally
+MAX_RESULT_ROWS = 100_000
+MAX_RESULT_BYTES = 256 * 1024 * 1024
+# How query results are rendered for the model (see serialize.SERIALIZERS)
+RESULT_FORMAT = serialize.DEFAULT_FORMAT
+RESULT_MAX_BYTES = serialize.DEFAULT_MAX_BYTES
+
+class StreamedResult:
+    """ Query results fetched in chunks over a server-side cursor.
+
+        The first chunk is read up front so the preview is available as soon as
+        the server returns it. A background thread then spills the remaining rows,
+        chunk by chunk, to an Arrow file in the result store, up to the row/byte
+        budget, and closes the cursor. Pages past the first chunk are read from that
+        file, so the query never runs twice, no connection is held once the rows are
+        local, and resident memory stays flat however large the result is.
+    """
+    def __init__(self, engine, query, chunk_rows=None, max_rows=None, max_bytes=None, cached=None, on_complete=None):
+        self.engine = engine
+        self.query = query
+        self.chunk_rows = chunk_rows or FETCH_CHUNK_ROWS
+        self.max_rows = max_rows or MAX_RESULT_ROWS
+        self.max_bytes = max_bytes or MAX_RESULT_BYTES
+        self.id = None
+        self.scope = None
+        self.stored = None
+        self.truncated = False
+        self.connection = None
+        self.backend_id = None
+        self.on_complete = on_complete
+        self._result = None
+        self._spiller = None
+        self._stop = threading.Event()
+
+        if cached is not None:
+            # Answered from the result cache: every row we kept is in the entry
+            self.first = cached.df
+            self.columns = list(cached.df.columns)
+            self.complete = True
+            self.truncated = cached.truncated
+            self.exhausted = True
+            return
+
+        self.exhausted = False
+        retry_on_disconnect(self._start)
+        self.columns = list(self.first.columns)
+        self.complete = self.exhausted
+        if self.complete:
+            self._completed()
+        else:
+            self._spiller = threading.Thread(target=self.spill, name="gptsql-spill", daemon=True)
+            self._spiller.start()
+
+    def _start(self):
+        try:
+            self._connect(check=True)
+            with query_guard.tracked(self.engine, self.backend_id):
+                self._execute()
+                self.first = self._fetch_chunk()
+        except Exception:
+            self.close()
+            raise
+
+    @classmethod
+    def from_frame(cls, query, df):
+        """ A complete result that was computed locally rather than by the database. """
+        return cls(None, query, cached=CacheEntry(None, set(), df, truncated=False))
+
+    def _connect(self, check=False):
+        self.connection = self.engine.connect()
+        self.exhausted = False
+        # A psycopg2 named cursor can only run SELECT/VALUES, so the session setup
+        # and the EXPLAIN run before streaming is switched on for the connection
+        self.backend_id = query_guard.prepare_connection(self.connection)
+        if check:
+            query_guard.check_query(self.connection, self.query)
+        # stream_results gives us a named cursor on psycopg2 and an unbuffered
+        # cursor on the MySQL-protocol drivers used for SingleStore
+        self.connection.execution_options(stream_results=True, max_row_buffer=self.chunk_rows)
+
+    def _execute(self):
+        self._result = self.connection.exec_driver_sql(self.query)
+        self._columns = list(self._result.keys())
+
+    def _fetch_chunk(self) -> pd.DataFrame:
+        rows = self._result.fetchmany(self.chunk_rows)
+        tracer.count("rows_fetched", len(rows))
+        if len(rows) < self.chunk_rows:
+            self.close()
+        return pd.DataFrame.from_records(rows, columns=self._columns)
+
+    def _completed(self):
+        if self.on_complete is not None:
+            self.on_complete(self)
+
+    @property
+    def row_count(self):
+        if self.stored is not None:
+            return self.stored.num_rows
+        return len(self.first)
+
+    @property
+    def more_rows(self):
+        """ Whether the server has rows we haven't counted yet. """
+        return self.truncated or not self.complete
+
+    @property
+    def preview(self) -> pd.DataFrame:
+        return self.first.head(PREVIEW_ROWS)
+
+    def wait(self):
+        """ Block until every row we are going to keep is local. """
+        if self._spiller is not None and self._spiller is not threading.current_thread():
+            self._spiller.join()
+
+    def page(self, start, count) -> pd.DataFrame:
+        """ Rows [start, start+count). Rows past the first chunk come from the spilled file. """
+        if start + count > len(self.first):
+            self.wait()
+        if self.stored is None:
+            return self.first.iloc[start:start + count]
+        return self.stored.read(start, count)
+
+    def frame(self) -> pd.DataFrame:
+        """ Every row we hold, as one DataFrame. """
+        if self.stored is None:
+            return self.first
+        return self.stored.read_table().to_pandas()
+
+    def spill(self):
+        with tracer.span("sql.spill") as attrs:
+            finished = self._spill()
+            attrs["rows"] = self.row_count
+        if finished:
+            self._completed()
+
+    def _spill(self):
+        """ Write every row, starting with the first chunk, to a file in the result store.
+            Returns whether the spill read the whole result (or its budget).
+        """
+        stored = result_store.new_file()
+        finished = False
+        try:
+            with query_guard.tracked(self.engine, self.backend_id):
+                chunk = self.first
+                while True:
+                    stored.append(chunk)
+                    if self.exhausted:
+                        break
+                    if self._stop.is_set() or stored.num_rows >= self.max_rows or stored.nbytes >= self.max_bytes:
+                        self.truncated = True
+                        break
+                    chunk = self._fetch_chunk()
+            finished = not self._stop.is_set()
+        except Exception:
+            # Cancelled, timed out or disconnected: keep what was read, reported as partial
+            self.truncated = True
+        finally:
+            self.close()
+            stored.finish()
+        if stored.num_rows > len(self.first):
+            self.stored = stored
+        else:
+            stored.delete()
+        self.complete = True
+        return finished
+
+    def close(self):
+        """ Release the server-side cursor. Rows already fetched stay available. """
+        if self.connection is None:
+            self.exhausted = True
+            return
+        self.exhausted = True
+        self._result = None
+        self.connection.close()
+        self.connection = None
+
+    def discard(self):
+        # Stop a spill still in progress before deleting its file
+        self._stop.set()
+        self.wait()
+        self.close()
+        if self.stored is not None:
+            self.stored.delete()
+            self.stored = None
+
+class CacheEntry:
+    def __init__(self, key, tables, df, truncated, created=None, ttl=None):
+        self.key = key
+        self.tables = tables
+        self.df = df
+        self.truncated = truncated
+        self.created = created or time.time()
+        self.ttl = ttl
+        self.nbytes = int(df.memory_usage(deep=True).sum())
 
-def call_my_function(engine, name, fargs = {}):
+    def expired(self, now=None):
+        return self.ttl is not None and (now or time.time()) - self.created > self.ttl
+
+TABLE_NAME = r'(?:["`]?[\w$]+["`]?\.)*["`]?[\w$]+["`]?'
+# A FROM list item: a table with an optional alias
+TABLE_ITEM = TABLE_NAME + r'(?:\s+(?:as\s+)?[\w$]+)?'
+JOIN_REF_RE = re.compile(r'\bjoin\s+(' + TABLE_NAME + ')', re.IGNORECASE)
+FROM_LIST_RE = re.compile(r'\bfrom\s+(' + TABLE_ITEM + r'(?:\s*,\s*' + TABLE_ITEM + r')*)', re.IGNORECASE)
+# Quoted literals and quoted identifiers, which are case sensitive
+QUOTED_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)""")
+
+def normalize_sql(query: str) -> str:
+    # Collapse whitespace outside of quoted literals and identifiers and drop trailing
+    # semicolons. Keyword case is only folded when there is nothing quoted to preserve.
+    parts = QUOTED_RE.split(query.strip().rstrip(';').strip())
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i])
+        if len(parts) == 1:
+            parts[i] = parts[i].lower()
+    return ''.join(parts).strip()
+
+def referenced_tables(query: str) -> set:
+    refs = JOIN_REF_RE.findall(query)
+    # "FROM a, b x, c AS y" joins with commas, so read every item in the list
+    for from_list in FROM_LIST_RE.findall(query):
+        refs += [re.match(TABLE_NAME, item.strip()).group(0) for item in from_list.split(',')]
+    tables = set()
+    for ref in refs:
+        name = ref.replace('"', '').replace('`', '').lower()
+        tables.add(name)
+        # also index the unqualified name so invalidate("orders") matches "public.orders"
+        tables.add(name.split('.')[-1])
+    return tables
+
+def connection_identity(engine) -> str:
+    return engine.url.render_as_string(hide_password=True)
+
+class ResultCache:
+    """ LRU cache of query results keyed on normalized SQL plus connection.
+
+        Entries are evicted least-recently-used once `max_bytes` is exceeded and
+        expire after `ttl` seconds. If `persist_dir` is set, entries are also
+        written to disk so they survive between sessions.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300, persist_dir=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist_dir = persist_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def make_key(self, engine, query):
+        raw = connection_identity(engine) + "\n" + normalize_sql(query)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, engine, query):
+        key = self.make_key(engine, query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self._load(key)
+                if entry is not None:
+                    self._insert(entry)
+            if entry is not None and entry.expired():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, engine, query, result):
+        """ Cache every row of a result once they are all local, so a hit never needs the database. """
+        if result.stored is not None and result.stored.nbytes > self.max_bytes:
+            return None
+        entry = CacheEntry(
+            self.make_key(engine, query),
+            referenced_tables(query),
+            result.frame(),
+            truncated=result.truncated,
+            ttl=self.ttl
+        )
+        if entry.nbytes > self.max_bytes:
+            return None
+        with self.lock:
+            if entry.key in self.entries:
+                self._remove(entry.key, from_disk=False)
+            self._insert(entry)
+            self._save(entry)
+        return entry
+
+    def invalidate(self, table=None):
+        """ Drop entries referencing `table`, or everything if no table is given. """
+        with self.lock:
+            table = table.lower() if table else None
+            for key, entry in list(self.entries.items()):
+                if table is None or table in entry.tables:
+                    self._remove(key)
+            for key, tables in self._disk_index():
+                if table is None or table in tables:
+                    self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _insert(self, entry):
+        self.entries[entry.key] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            key, _ = next(iter(self.entries.items()))
+            self._remove(key, from_disk=False)
+            self.evictions += 1
+
+    def _remove(self, key, from_disk=True):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+        if from_disk and self.persist_dir:
+            # .pkl files were written by older versions; they are never loaded
+            for ext in (".json", ".arrow", ".pkl"):
+                path = os.path.join(self.persist_dir, key + ext)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _save(self, entry):
+        import pyarrow as pa
+
+        if not self.persist_dir:
+            return
+        # Arrow IPC holds only data, so a tampered cache directory can't run code on load
+        try:
+            table = pa.Table.from_pandas(entry.df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # Mixed-type columns can't be stored as Arrow; keep the entry in memory only
+            return
+        os.makedirs(self.persist_dir, exist_ok=True)
+        base = os.path.join(self.persist_dir, entry.key)
+        with pa.OSFile(base + ".arrow", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        with open(base + ".json", "w") as f:
+            f.write(json.dumps({
+                "tables": sorted(entry.tables),
+                "truncated": entry.truncated,
+                "created": entry.created,
+            }))
+
+    def _load(self, key):
+        import pyarrow as pa
+
+        if not self.persist_dir:
+            return None
+        base = os.path.join(self.persist_dir, key)
+        try:
+            with open(base + ".json") as f:
+                meta = json.loads(f.read())
+            with pa.memory_map(base + ".arrow", "r") as source:
+                df = pa.ipc.open_file(source).read_all().to_pandas()
+        except (OSError, ValueError, KeyError, pa.ArrowException):
+            return None
+        return CacheEntry(key, set(meta["tables"]), df, meta["truncated"], created=meta["created"], ttl=self.ttl)
+
+    def _disk_index(self):
+        if not self.persist_dir or not os.path.isdir(self.persist_dir):
+            return []
+        index = []
+        for fname in os.listdir(self.persist_dir):
+            if fname.endswith(".json"):
+                try:
+                    with open(os.path.join(self.persist_dir, fname)) as f:
+                        index.append((fname[:-5], set(json.loads(f.read())["tables"])))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return index
+
+result_cache = ResultCache()
+result_store = ResultStore()
+last_results: StreamedResult = None
+# Where "next page" continues from in the CLI
+page_cursor = {"id": None, "start": 0}
+PAGE_ROWS = 200
+
+def set_last_results(result, scope=None):
     global last_results
+    result_store.add(result, scope)
+    last_results = result
+
+def print_results_page(result_id=None, start=0, count=PAGE_ROWS, scope=None):
+    result = result_store.get(result_id, scope=scope)
+    if result is None:
+        print("No results to show")
+        return
+    df = result.page(start, count)
+    df.index = range(start, start + len(df))
+    with pd.option_context('display.max_rows', count, 'display.min_rows', count):
+        print(df)
+    more = "+" if result.more_rows else ""
+    print(f"(rows {start}-{start + len(df) - 1} of {result.row_count}{more} in {result.id})")
+    page_cursor.update(id=result.id, start=start + len(df))
 
+def call_my_function(engine, name, fargs = {}, scope=None):
+    # `scope` is the Assistants thread making the call; results it stores and the
+    # "newest result" it sees are its own (see ResultStore)
     if name == "run_sql_command":
         query = fargs.get("query")
         if query and query.lower().startswith("select"):
             query = query.replace('%', '%%')
+            query = query_guard.apply_limit(query, query_guard.AUTO_LIMIT)
             print(colored(query, "blue"))
             try:
-                # convert DataFrame to json
-                last_results = pd.read_sql_query(query, engine)
-                if last_results.shape[0] > 20:
-                    return last_results.head(20).to_json()
+                entry = result_cache.get(engine, query)
+                if entry is not None:
+                    tracer.count("cache_hits")
+                    result = StreamedResult(engine, query, cached=entry)
                 else:
-                    return last_results.to_json()
+                    with tracer.span("sql.execute"):
+                        # Cached once the rest of the rows have been spilled
+                        result = StreamedResult(engine, query, on_complete=lambda r: result_cache.put(engine, query, r))
+                set_last_results(result, scope)
+                with tracer.span("serialize"):
+                    return serialize.serialize_result(
+                        result.preview,
+                        total_rows=result.row_count,
+                        more_rows=result.more_rows,
+                        fmt=RESULT_FORMAT,
+                        max_bytes=RESULT_MAX_BYTES,
+                        meta={"result_id": result.id}
+                    )
+            except query_guard.QueryRejected as e:
+                print(colored(str(e), "red"))
+                return {"error": str(e)}
             except Exception as e:
                 print(colored(f"Database query failed: {e}", "red"))
-                return {"error", f" Database query failed: {e}"}
+                return {"error": f" Database query failed: {e}"}
         else:
             print("Invalid query: ", query)
             return {"error": f"Failed to run non-select query '{query}'"}
+    elif name == "query_stored_results":
+        query = fargs.get("query") or ""
+        print(colored("[local] " + query, "cyan"))
+        try:
+            sources = local_query.result_frames(result_store, query, scope)
+            df = local_query.run_local_query(result_store, query, sources, scope)
+        except Exception as e:
+            print(colored(f"Local query failed: {e}", "red"))
+            return {"error": f"Local query failed: {e}"}
+        result = StreamedResult.from_frame(query, df)
+        set_last_results(result, scope)
+        meta = {"result_id": result.id}
+        # Sources cut off at the row/byte budget; only a narrower run_sql_command
+        # can get at the rows past it
+        partial = sorted(f"{name} ({source.row_count} rows)" for name, source in sources.items() if source.more_rows)
+        if partial:
+            meta["partial_sources"] = ", ".join(partial)
+        with tracer.span("serialize"):
+            return serialize.serialize_result(
+                result.preview,
+                total_rows=result.row_count,
+                fmt=RESULT_FORMAT,
+                max_bytes=RESULT_MAX_BYTES,
+                meta=meta
+            )
+    elif name in ["profile_table", "profile_query"]:
+        table = fargs.get("table") if name == "profile_table" else None
+        query = fargs.get("query") if name == "profile_query" else None
+        if query is not None:
+            if not query.lower().lstrip().startswith("select"):
+                return {"error": f"Failed to profile non-select query '{query}'"}
+            query = query.replace('%', '%%')
+        print(colored(f"[profile] {table or query}", "blue"))
+        try:
+            return retry_on_disconnect(
+                lambda: table_profile.profile(engine, table=table, query=query, max_bytes=RESULT_MAX_BYTES)
+            )
+        except query_guard.QueryRejected as e:
+            print(colored(str(e), "red"))
+            return {"error": str(e)}
+        except Exception as e:
+            print(colored(f"Profiling failed: {e}", "red"))
+            return {"error": f"Profiling failed: {e}"}
     elif name == "show_long_query_results_on_demand":
-        if last_results is None:
-            print("No results to show")
-        else:
-            print("LAST QUERY RESULTS:")
-            with pd.option_context('display.max_rows', 200, 'display.min_rows', 200):
-                print(last_results)
+        print("LAST QUERY RESULTS:")
+        print_results_page(scope=scope)
         return "OK"
-
-def get_table_list(engine, schema = "public"):
-    sql = f"""
-        SELECT table_name from INFORMATION_SCHEMA.tables where table_schema = '{schema}' ORDER BY table_name
-    """
-    with engine.connect() as connection:
-        rows = list(connection.execute(text(sql)))
-        return [r[0] for r in  rows]
+    elif name == "get_query_results_page":
+        result = result_store.get(fargs.get("result_id"), scope=scope)
+        if result is None:
+            return {"error": f"No stored results with id '{fargs.get('result_id')}'"}
+        start = int(fargs.get("start_row", 0))
+        count = int(fargs.get("num_rows", PREVIEW_ROWS))
+        df = result.page(start, count)
+        with tracer.span("serialize"):
+            return serialize.serialize_result(
+                df,
+                total_rows=result.row_count,
+                more_rows=result.more_rows,
+                fmt=RESULT_FORMAT,
+                max_bytes=RESULT_MAX_BYTES,
+                meta={"result_id": result.id, "start_row": start}
+            )
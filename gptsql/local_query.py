@@ -0,0 +1,115 @@
+import re
+import sqlite3
+import threading
+
+import pandas as pd
+
+from .tracing import tracer
+
+# Previous results are tables named by their result id; this one is always the newest
+LAST_RESULT_TABLE = "last_result"
+
+def result_frames(store, query, scope=None):
+    """ {table name: result} for each stored result in `scope` the query refers to. """
+    names = {name.lower() for name in re.findall(r'\b(r\d+|' + LAST_RESULT_TABLE + r')\b', query, re.IGNORECASE)}
+    results = {}
+    for name in names:
+        result = store.get(None if name == LAST_RESULT_TABLE else name, scope=scope)
+        if result is None:
+            raise ValueError(f"No stored results named '{name}'")
+        results[name] = result
+    return results
+
+def result_data(result):
+    """ The rows of a stored result that we hold locally, as an Arrow table or a DataFrame.
+
+        This never goes back to the database. It waits for a spill still in progress;
+        a result cut off at its budget is queried as far as it was read, and callers
+        report it as partial.
+    """
+    result.wait()
+    if result.stored is not None:
+        return result.stored.read_table()
+    return result.first
+
+class DuckDBEngine:
+    """ Runs queries with DuckDB, which scans the DataFrames and Arrow files in place. """
+    name = "duckdb"
+
+    def query(self, sql, results):
+        import duckdb
+
+        connection = duckdb.connect()
+        try:
+            for name, result in results.items():
+                connection.register(name, result_data(result))
+            return connection.execute(sql).df()
+        finally:
+            connection.close()
+
+class SQLiteEngine:
+    """ Runs queries with an in-memory SQLite database.
+
+        Each stored result is copied in the first time it is queried and kept until it
+        is evicted from the result store, so follow-ups on the same result are fast.
+    """
+    name = "sqlite"
+
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def load(self, result):
+        if self.loaded.get(result.id) == result.row_count:
+            return
+        data = result_data(result)
+        df = data.copy() if isinstance(data, pd.DataFrame) else data.to_pandas()
+        # SQLite only stores numbers, text and blobs
+        for column in df.columns:
+            if df[column].dtype == object or isinstance(df[column].dtype, pd.DatetimeTZDtype):
+                df[column] = df[column].map(lambda v: v if v is None or isinstance(v, (int, float, str, bytes)) else str(v))
+        df.to_sql(result.id, self.connection, if_exists="replace", index=False)
+        self.loaded[result.id] = result.row_count
+
+    def query(self, sql, results):
+        with self.lock:
+            for result in results.values():
+                self.load(result)
+            for name, result in results.items():
+                if name == LAST_RESULT_TABLE:
+                    sql = re.sub(r'\b' + LAST_RESULT_TABLE + r'\b', result.id, sql, flags=re.IGNORECASE)
+            return pd.read_sql_query(sql, self.connection)
+
+    def forget(self, keep_ids):
+        with self.lock:
+            for result_id in list(self.loaded):
+                if result_id not in keep_ids:
+                    self.connection.execute(f'DROP TABLE IF EXISTS "{result_id}"')
+                    del self.loaded[result_id]
+
+_engine = None
+
+def local_engine():
+    # DuckDB if it is installed, otherwise SQLite from the standard library
+    global _engine
+    if _engine is None:
+        try:
+            import duckdb
+            _engine = DuckDBEngine()
+        except ImportError:
+            _engine = SQLiteEngine()
+    return _engine
+
+def run_local_query(store, query, results=None, scope=None) -> pd.DataFrame:
+    """ Run `query` over stored results, referring to them by result id or as last_result. """
+    if results is None:
+        results = result_frames(store, query, scope)
+    if not results:
+        raise ValueError(f"The query doesn't refer to any stored results (r1, r2, ... or {LAST_RESULT_TABLE})")
+    engine = local_engine()
+    with tracer.span("local.query", engine=engine.name):
+        df = engine.query(query, results)
+    if isinstance(engine, SQLiteEngine):
+        engine.forget(set(store.results))
+    return df
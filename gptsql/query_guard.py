@@ -0,0 +1,205 @@
+from contextlib import contextmanager
+import itertools
+import json
+import re
+import threading
+
+from termcolor import colored
+
+from .tracing import tracer
+
+# Queries the planner thinks will cost more than this are rejected (Postgres cost units)
+MAX_QUERY_COST = 10_000_000
+# Queries the planner expects to return (Postgres) or read (SingleStore, the largest
+# row estimate anywhere in the plan) more rows than this are rejected (None to disable).
+# SingleStore's EXPLAIN reports no cost, so this is the only check it gets.
+MAX_ESTIMATED_ROWS = 100_000_000
+# Ask the planner before running each query
+EXPLAIN_QUERIES = True
+# Append a LIMIT to queries without one, so the server never produces more rows
+# than we would keep (set to None to disable)
+AUTO_LIMIT = 100_000
+# Statements running longer than this are cancelled on the server
+STATEMENT_TIMEOUT = 60
+
+class QueryRejected(Exception):
+    pass
+
+def strip_literals(query: str) -> str:
+    # Blank out quoted strings and identifiers so keyword searches don't match inside them
+    return re.sub(r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`", "''", query)
+
+def top_level(query: str) -> str:
+    """ The query text with literals and anything inside parentheses removed. """
+    text = strip_literals(query)
+    out, depth = [], 0
+    for ch in text:
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth = max(0, depth - 1)
+        elif depth == 0:
+            out.append(ch)
+    return "".join(out)
+
+def apply_limit(query: str, limit) -> str:
+    if not limit:
+        return query
+    outer = top_level(query).lower()
+    if re.search(r'\b(limit|fetch\s+first)\b', outer):
+        return query
+    return query.strip().rstrip(';') + f"\nLIMIT {int(limit)}"
+
+def max_in_plan(node, keys):
+    """ Largest numeric value stored under any of `keys` anywhere in a JSON plan. """
+    best = None
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k in keys:
+                try:
+                    value = float(v)
+                    best = value if best is None else max(best, value)
+                except (TypeError, ValueError):
+                    pass
+            sub = max_in_plan(v, keys)
+            if sub is not None:
+                best = sub if best is None else max(best, sub)
+    elif isinstance(node, list):
+        for item in node:
+            sub = max_in_plan(item, keys)
+            if sub is not None:
+                best = sub if best is None else max(best, sub)
+    return best
+
+def estimate(connection, query):
+    """ Returns (cost, rows) from the planner, either of which may be None. """
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + query).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        top = plan[0]["Plan"]
+        return top.get("Total Cost"), top.get("Plan Rows")
+    if dialect in ["mysql", "singlestoredb"]:
+        rows = connection.exec_driver_sql("EXPLAIN JSON " + query).fetchall()
+        plan = json.loads("".join(str(r[0]) for r in rows))
+        return None, max_in_plan(plan, {"est_rows", "estimated_rows", "rows_examined_per_scan"})
+    return None, None
+
+def limits_apply(dialect):
+    """ Whether any threshold can reject a query on `dialect`; if not, EXPLAIN is skipped. """
+    if dialect == "postgresql":
+        return bool(MAX_QUERY_COST or MAX_ESTIMATED_ROWS)
+    if dialect in ["mysql", "singlestoredb"]:
+        return bool(MAX_ESTIMATED_ROWS)
+    return False
+
+def check_query(connection, query):
+    """ Raise QueryRejected if the planner expects the query to be too expensive. """
+    if not EXPLAIN_QUERIES or not limits_apply(connection.dialect.name):
+        return
+    try:
+        with tracer.span("sql.explain"):
+            cost, rows = estimate(connection, query)
+    except Exception as e:
+        # Some statements can't be explained; let the timeout protect us instead
+        print(colored(f"EXPLAIN failed, running without a cost check: {e}", "yellow"))
+        connection.rollback()
+        return
+    if MAX_QUERY_COST and cost is not None and cost > MAX_QUERY_COST:
+        raise QueryRejected(
+            f"Query rejected: estimated cost {cost:,.0f} exceeds the limit of {MAX_QUERY_COST:,}. "
+            "Add filters, aggregate on the server or query a smaller table."
+        )
+    if MAX_ESTIMATED_ROWS and rows is not None and rows > MAX_ESTIMATED_ROWS:
+        raise QueryRejected(
+            f"Query rejected: an estimated {rows:,.0f} rows exceeds the limit of {MAX_ESTIMATED_ROWS:,}. "
+            "Add filters or aggregate on the server."
+        )
+
+BACKEND_ID_SQL = {
+    "postgresql": "SELECT pg_backend_pid()",
+    "mysql": "SELECT CONNECTION_ID()",
+    "singlestoredb": "SELECT CONNECTION_ID()",
+}
+
+def prepare_connection(connection):
+    """ Look up the server-side id of a pooled connection and apply the statement timeout.
+
+        Both are stored in the pool's per-connection `info`, so this costs a round trip
+        only the first time a connection is used. Call it before setting stream_results:
+        psycopg2 named cursors reject anything but SELECT.
+    """
+    info = connection.info
+    dialect = connection.dialect.name
+    if "backend_id" not in info and dialect in BACKEND_ID_SQL:
+        info["backend_id"] = connection.exec_driver_sql(BACKEND_ID_SQL[dialect]).scalar()
+    if info.get("statement_timeout") != STATEMENT_TIMEOUT and dialect == "postgresql":
+        connection.exec_driver_sql(f"SET statement_timeout = {int((STATEMENT_TIMEOUT or 0) * 1000)}")
+        info["statement_timeout"] = STATEMENT_TIMEOUT
+    if connection.in_transaction():
+        connection.commit()
+    return info.get("backend_id")
+
+running = {}
+running_lock = threading.Lock()
+_running_ids = itertools.count(1)
+
+def cancel_backend(engine, backend_id):
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        sql = f"SELECT pg_cancel_backend({int(backend_id)})"
+    elif dialect in ["mysql", "singlestoredb"]:
+        sql = f"KILL QUERY {int(backend_id)}"
+    else:
+        return
+    # Open a connection outside the pool, whose connections may all be busy
+    # running the very queries we are cancelling. A recreated pool connects with
+    # the same credentials and connect arguments but shares no connections.
+    pool = engine.pool.recreate()
+    try:
+        connection = pool.connect()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(sql)
+            cursor.close()
+        finally:
+            connection.close()
+    finally:
+        pool.dispose()
+    tracer.count("queries_cancelled")
+
+@contextmanager
+def tracked(engine, backend_id, timeout=None):
+    """ Register a running statement so it can be cancelled, and cancel it after `timeout`. """
+    if backend_id is None:
+        yield
+        return
+    key = next(_running_ids)
+    with running_lock:
+        running[key] = (engine, backend_id)
+    timer = None
+    timeout = STATEMENT_TIMEOUT if timeout is None else timeout
+    if timeout:
+        # Backends without a server-side statement timeout get cancelled from here
+        timer = threading.Timer(timeout, cancel_backend, (engine, backend_id))
+        timer.daemon = True
+        timer.start()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.cancel()
+        with running_lock:
+            running.pop(key, None)
+
+def cancel_running():
+    """ Cancel every statement still running on the server. Returns how many were cancelled. """
+    with running_lock:
+        targets = list(running.values())
+    for engine, backend_id in targets:
+        try:
+            cancel_backend(engine, backend_id)
+        except Exception as e:
+            print(colored(f"Failed to cancel query on backend {backend_id}: {e}", "red"))
+    return len(targets)
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import json
+import os
+import re
+import threading
+import time
+
+from .schema_index import stem
+from .utils import write_atomic
+
+QUESTION_CACHE_FILE = os.path.expanduser('~/.gptsql_questions')
+# How many distinct questions we remember
+DEFAULT_MAX_QUESTIONS = 200
+
+# Words, with numbers and dates kept whole ("1.5", "2024-01-31"), and the symbols that
+# change what a question asks for ("> 100", "10%")
+QUESTION_TOKEN_RE = re.compile(r'[a-z0-9]+(?:[.:/-][a-z0-9]+)*|[<>=!%$€£-]+')
+
+# Questions that lean on earlier turns: "and last month?", "now group that by region",
+# "only the US", "sort them by revenue", "what about r3?", "count last_result"
+FOLLOW_UP_START_RE = re.compile(
+    r'^(and|but|also|now|then|so|or|ok|okay|only|just|except|excluding|without|same|instead|'
+    r'what about|how about|why)\b'
+)
+FOLLOW_UP_RE = re.compile(
+    r'\b(it|its|they|them|those|these|previous|previously|above|earlier|again|instead|too|'
+    r'the results?|(that|this|same|last) (one|ones|query|result|results|list|answer|number|table)|'
+    r'r\d+)\b'
+)
+
+def normalize_question(question: str) -> str:
+    # Case, punctuation, whitespace and plurals don't matter; every word does, so
+    # "how many orders?" and "list all orders" are different questions
+    return " ".join(stem(t) for t in QUESTION_TOKEN_RE.findall(question.lower()))
+
+def is_follow_up(question: str) -> bool:
+    """ Whether a question probably refers back to earlier turns, so its meaning (and the
+        SQL that answered it) depends on the conversation. Errs towards yes: a follow-up
+        taken for a new question would replay an answer to something else.
+    """
+    text = " ".join(QUESTION_TOKEN_RE.findall(question.lower()))
+    return bool(FOLLOW_UP_START_RE.search(text) or FOLLOW_UP_RE.search(text))
+
+class QuestionCache:
+    """ Remembers the SQL that answered a question, so asking it again can skip the model.
+
+        Entries are keyed on the normalized question text and remember the schema
+        fingerprint they were recorded under; an entry is dropped when the schema has
+        changed since. The least recently used entries are evicted beyond `max_entries`.
+        The cache is saved to `path` so it carries over between sessions.
+    """
+    def __init__(self, path=QUESTION_CACHE_FILE, max_entries=DEFAULT_MAX_QUESTIONS):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.loads(f.read())
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self.entries = OrderedDict()
+            for e in entries:
+                # Keys are re-derived so entries saved under an older normalization can't
+                # match a question they weren't recorded for
+                e["key"] = normalize_question(e["question"])
+                self.entries[e["key"]] = e
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(list(self.entries.values()))
+        write_atomic(self.path, data)
+
+    def get(self, question, fingerprint):
+        key = normalize_question(question)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["fingerprint"] != fingerprint:
+                # Recorded against a different schema, the SQL may no longer be valid
+                del self.entries[key]
+                self.save()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            entry["hits"] += 1
+            entry["used_at"] = time.time()
+            self.hits += 1
+            self.save()
+            return entry
+
+    def put(self, question, fingerprint, sql, answer):
+        key = normalize_question(question)
+        if not key:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = {
+                "key": key,
+                "question": question,
+                "fingerprint": fingerprint,
+                "sql": sql,
+                "answer": answer,
+                "created": time.time(),
+                "used_at": time.time(),
+                "hits": 0,
+            }
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.save()
+
+    def forget(self, question=None):
+        """ Drop one question, or everything if no question is given. """
+        with self.lock:
+            if question is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(normalize_question(question), None)
+            self.save()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+
+# How many query results stay addressable for paging
+DEFAULT_KEEP_RESULTS = 10
+
+class StoredResult:
+    """ Query rows spilled to an Arrow IPC file on disk.
+
+        Rows are appended one chunk at a time, so nothing beyond the current chunk
+        is held in memory. Reads memory-map the file and only convert the requested
+        slice back to pandas.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.num_rows = 0
+        self.nbytes = 0
+        self.schema = None
+        self._sink = None
+        self._writer = None
+
+    def append(self, df: pd.DataFrame):
+        import pyarrow as pa
+
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            # Columns that were all NULL in the first chunk have no type yet
+            self.schema = pa.schema([
+                f.with_type(pa.string()) if pa.types.is_null(f.type) else f for f in table.schema
+            ]).remove_metadata()
+            table = table.cast(self.schema)
+            self._sink = pa.OSFile(self.path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+        else:
+            try:
+                table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False, safe=False)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Values that don't fit the first chunk's types are kept as text
+                table = pa.Table.from_pandas(df.astype(str), preserve_index=False).cast(self.schema, safe=False)
+        self._writer.write_table(table)
+        self.num_rows += table.num_rows
+        self.nbytes += table.nbytes
+
+    def finish(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+            self._writer = None
+
+    def read(self, start, count) -> pd.DataFrame:
+        return self.read_table().slice(start, count).to_pandas()
+
+    def read_table(self):
+        """ The whole result as an Arrow table backed by the memory-mapped file. """
+        import pyarrow as pa
+
+        with pa.memory_map(self.path, 'r') as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def delete(self):
+        self.finish()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class ResultStore:
+    """ The last `keep` query results, addressable by id ("r1", "r2", ...).
+
+        Each result belongs to a scope, the Assistants thread whose tool call produced
+        it. Lookups within a scope only see that scope's results, and "the newest
+        result" is the newest one in the scope, so concurrent batch questions never
+        read each other's data. A scope of None (the CLI) sees everything.
+
+        Results larger than their first chunk are spilled to files in `directory`
+        as soon as the first chunk has been read.
+    """
+    def __init__(self, keep=DEFAULT_KEEP_RESULTS, directory=None):
+        self.keep = keep
+        self._directory = directory
+        self.results = OrderedDict()
+        # scope -> id of its newest result
+        self.latest = {}
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix="gptsql-results-")
+            atexit.register(shutil.rmtree, self._directory, True)
+        os.makedirs(self._directory, exist_ok=True)
+        return self._directory
+
+    def add(self, result, scope=None):
+        with self.lock:
+            self.counter += 1
+            result.id = f"r{self.counter}"
+            result.scope = scope
+            self.results[result.id] = result
+            self.latest[scope] = result.id
+            while len(self.results) > self.keep:
+                evicted_id, evicted = self.results.popitem(last=False)
+                if self.latest.get(evicted.scope) == evicted_id:
+                    del self.latest[evicted.scope]
+                evicted.discard()
+            return result.id
+
+    def get(self, result_id=None, scope=None):
+        with self.lock:
+            if result_id is None:
+                if scope is None:
+                    return next(reversed(self.results.values()), None)
+                return self.results.get(self.latest.get(scope))
+            result = self.results.get(result_id)
+            if result is not None and scope is not None and result.scope != scope:
+                return None
+            return result
+
+    def new_file(self) -> StoredResult:
+        # Spilling starts before the result has an id, so the file gets a name of its own
+        fd, path = tempfile.mkstemp(suffix=".arrow", dir=self.directory)
+        os.close(fd)
+        return StoredResult(path)
+
+    def clear(self):
+        with self.lock:
+            for result in self.results.values():
+                result.discard()
+            self.results.clear()
+            self.latest.clear()
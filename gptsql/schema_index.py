@@ -0,0 +1,121 @@
+from collections import Counter, defaultdict
+import heapq
+import math
+import re
+import threading
+
+# Only this many tables (with their columns) go into each message
+DEFAULT_TOP_K = 8
+# Below this size we still list every table name after the relevant ones
+SMALL_SCHEMA_TABLES = 100
+
+# BM25 tuning
+K1 = 1.2
+B = 0.75
+# Table name terms count for more than column names or comments
+NAME_WEIGHT = 3
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "by", "do", "for", "from", "how", "i", "in", "is", "it",
+    "me", "of", "on", "or", "show", "that", "the", "this", "to", "was", "what", "which",
+    "with", "all", "give", "list", "many", "much", "table", "tables",
+}
+
+def stem(token: str) -> str:
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+def tokenize(value: str):
+    # Split snake_case, camelCase and punctuation, e.g. "userOrder_items" -> user, order, item
+    value = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', value or "")
+    return [stem(t) for t in re.findall(r'[a-z0-9]+', value.lower()) if t not in STOPWORDS]
+
+class SchemaIndex:
+    """ BM25 inverted index over table names, column names and comments.
+
+        `search()` picks the tables most relevant to a question so only a small slice
+        of the schema has to be sent with each message. Scoring only walks the postings
+        for the question's terms, so it stays fast for catalogs with thousands of tables.
+    """
+    def __init__(self, catalog, top_k=DEFAULT_TOP_K):
+        self.catalog = catalog
+        self.top_k = top_k
+        self.version = None
+        self.tables = []
+        self.postings = {}
+        self.idf = {}
+        self.norms = []
+        # Batch mode searches from several threads at once
+        self.lock = threading.Lock()
+
+    def ensure_current(self):
+        with self.lock:
+            if self.version != self.catalog.version:
+                self.build()
+
+    def build(self):
+        with self.catalog.lock:
+            version = self.catalog.version
+            tables = sorted(self.catalog.tables.items())
+
+        postings = defaultdict(list)
+        lengths = []
+        for doc_id, (name, info) in enumerate(tables):
+            terms = Counter()
+            for token in tokenize(name):
+                terms[token] += NAME_WEIGHT
+            terms.update(tokenize(info.get("comment", "")))
+            for column, _, comment in info.get("columns", []):
+                terms.update(tokenize(column))
+                terms.update(tokenize(comment))
+            for token, tf in terms.items():
+                postings[token].append((doc_id, tf))
+            lengths.append(sum(terms.values()))
+
+        n = len(tables)
+        avg_len = (sum(lengths) / n) if n else 1
+        self.tables = [name for name, _ in tables]
+        self.postings = dict(postings)
+        self.idf = {
+            token: math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for token, docs in self.postings.items()
+        }
+        self.norms = [K1 * (1 - B + B * length / avg_len) for length in lengths]
+        self.version = version
+
+    def search(self, question: str, top_k=None):
+        """ Return [(table, score)] for the best matching tables, highest first. """
+        self.ensure_current()
+        with self.lock:
+            tables, postings, idf_by_token, norms = self.tables, self.postings, self.idf, self.norms
+        scores = defaultdict(float)
+        for token in set(tokenize(question)):
+            idf = idf_by_token.get(token)
+            if idf is None:
+                continue
+            for doc_id, tf in postings[token]:
+                scores[doc_id] += idf * tf * (K1 + 1) / (tf + norms[doc_id])
+        best = heapq.nlargest(top_k or self.top_k, scores.items(), key=lambda item: item[1])
+        return [(tables[doc_id], score) for doc_id, score in best]
+
+    def schema_slice(self, question: str, top_k=None) -> str:
+        """ Compact description of the tables relevant to `question`, for the prompt. """
+        matches = [table for table, _ in self.search(question, top_k)]
+        lines = []
+        if matches:
+            lines.append("Tables in the database relevant to this question (table(column type, ...)):")
+            for table in matches:
+                columns = ", ".join(f"{c} {t}" for c, t, _ in self.catalog.columns(table))
+                comment = self.catalog.tables.get(table, {}).get("comment")
+                lines.append(f"{table}({columns})" + (f" -- {comment}" if comment else ""))
+        if len(self.tables) <= SMALL_SCHEMA_TABLES:
+            others = [t for t in self.tables if t not in matches]
+            if others:
+                lines.append("Other tables: " + ",".join(others))
+        elif not matches:
+            lines.append(f"The database has {len(self.tables)} tables; none matched this question by name. "
+                         "Query information_schema to find the relevant ones.")
+        return "\n".join(lines)
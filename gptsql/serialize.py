@@ -0,0 +1,105 @@
+import json
+import math
+
+import pandas as pd
+
+# Roughly 1,000 tokens of tool output per query
+DEFAULT_MAX_BYTES = 4000
+DEFAULT_FORMAT = "csv"
+# Longer text values are cut down to this many characters
+MAX_CELL_CHARS = 120
+# Significant digits for floats: as many as a double holds, so totals and averages
+# reach the model exactly, while 0.1 + 0.2 still prints as 0.3
+FLOAT_DIGITS = 15
+
+def format_value(value, max_chars=MAX_CELL_CHARS):
+    if value is None or value is pd.NaT or value is pd.NA:
+        return ""
+    if isinstance(value, float):
+        return "" if math.isnan(value) else f"{value:.{FLOAT_DIGITS}g}"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, pd.Timestamp):
+        # Drop the time part when it's just midnight
+        return value.date().isoformat() if value == value.normalize() else value.isoformat()
+    if isinstance(value, (list, dict, tuple)):
+        text = json.dumps(value, default=str)
+    else:
+        text = value if isinstance(value, str) else str(value)
+    if len(text) > max_chars:
+        return text[:max_chars - 1] + "…"
+    return text
+
+def to_csv(df, meta):
+    lines = [f"# {k}: {v}" for k, v in meta.items()]
+    lines.append(",".join(csv_field(c) for c in df.columns))
+    for row in df.itertuples(index=False):
+        lines.append(",".join(csv_field(v) for v in row))
+    return "\n".join(lines)
+
+def csv_field(value):
+    if any(c in value for c in ',"\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+def to_markdown(df, meta):
+    lines = [f"{k}: {v}" for k, v in meta.items()]
+    lines.append("|" + "|".join(df.columns) + "|")
+    lines.append("|" + "|".join("---" for _ in df.columns) + "|")
+    for row in df.itertuples(index=False):
+        lines.append("|" + "|".join(v.replace("|", "\\|").replace("\n", " ") for v in row) + "|")
+    return "\n".join(lines)
+
+def to_columns(df, meta):
+    return json.dumps({
+        "meta": meta,
+        "columns": list(df.columns),
+        "data": {col: df[col].tolist() for col in df.columns},
+    }, separators=(",", ":"), ensure_ascii=False)
+
+SERIALIZERS = {
+    "csv": to_csv,
+    "markdown": to_markdown,
+    "columns": to_columns,
+}
+
+def register_serializer(name, func):
+    """ Add an output format. `func(df, meta)` gets string-formatted cells and returns a str. """
+    SERIALIZERS[name] = func
+
+def serialize_result(df: pd.DataFrame, total_rows=None, more_rows=False, fmt=None, max_bytes=None, meta=None):
+    """ Render query results for the model, shrinking them to fit `max_bytes`.
+
+        Rows are dropped first, then trailing columns, then long values are cut shorter.
+        What was left out is reported in the metadata so the model knows the output
+        is partial. Entries in `meta` are passed through ahead of that.
+    """
+    fmt = fmt or DEFAULT_FORMAT
+    max_bytes = max_bytes or DEFAULT_MAX_BYTES
+    serializer = SERIALIZERS[fmt]
+    total_rows = len(df) if total_rows is None else total_rows
+    df = df.rename(columns=str)
+    extra_meta = meta or {}
+
+    max_chars = MAX_CELL_CHARS
+    rows, cols = len(df), len(df.columns)
+    while True:
+        shown = df.iloc[:rows, :cols]
+        shown = shown.apply(lambda s: s.map(lambda v: format_value(v, max_chars)))
+        meta = dict(extra_meta, rows=f"{rows} of {total_rows}{'+' if more_rows else ''}")
+        if cols < len(df.columns):
+            meta["omitted_columns"] = ",".join(df.columns[cols:])
+        cut = [c for c in shown.columns if shown[c].map(lambda v: len(v) == max_chars and v.endswith("…")).any()]
+        if cut:
+            meta["truncated_columns"] = f"{','.join(cut)} (values cut to {max_chars} chars)"
+        out = serializer(shown, meta)
+        if len(out.encode()) <= max_bytes:
+            return out
+        if rows > 1:
+            rows = max(1, rows // 2)
+        elif cols > 1:
+            cols -= 1
+        elif max_chars > 16:
+            max_chars //= 2
+        else:
+            return out[:max_bytes]
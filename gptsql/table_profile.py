@@ -0,0 +1,224 @@
+import decimal
+import re
+
+import numpy as np
+import pandas as pd
+
+from . import query_guard
+from .serialize import format_value
+from .tracing import tracer
+
+# Rows pulled for quantiles, histograms and top values
+SAMPLE_ROWS = 10_000
+HISTOGRAM_BINS = 10
+TOP_VALUES = 5
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+# Columns with at most this many distinct values also get their top values listed
+LOW_CARDINALITY = 20
+
+IDENTIFIER_RE = re.compile(r'^[A-Za-z_][\w$]*(\.[A-Za-z_][\w$]*)?$')
+
+RANDOM_FUNCTION = {
+    "postgresql": "random()",
+    "mysql": "RAND()",
+    "singlestoredb": "RAND()",
+}
+
+def column_kind(series: pd.Series):
+    if pd.api.types.is_bool_dtype(series):
+        return "bool"
+    if pd.api.types.is_numeric_dtype(series):
+        return "numeric"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "datetime"
+    return "text"
+
+def as_numeric(series: pd.Series) -> pd.Series:
+    # psycopg2 returns NUMERIC columns as Decimal objects
+    values = series.dropna()
+    if series.dtype == object and len(values) and isinstance(values.iloc[0], decimal.Decimal):
+        return pd.to_numeric(series, errors="coerce")
+    return series
+
+def estimate_distinct(counts: pd.Series, sample_rows, total_rows):
+    """ Distinct values in the whole column, from the value counts of a sample.
+
+        Uses the Haas-Stokes (Duj1) estimator, as Postgres' ANALYZE does: the more
+        values were seen only once in the sample, the more unseen values we assume.
+    """
+    distinct = len(counts)
+    if not total_rows or sample_rows >= total_rows or not distinct:
+        return distinct
+    once = int((counts == 1).sum())
+    estimate = sample_rows * distinct / (sample_rows - once + once * sample_rows / total_rows)
+    return int(round(min(max(estimate, distinct), total_rows)))
+
+def sample_sql(dialect, table, source, est_rows):
+    """ SQL for a sample of about SAMPLE_ROWS rows, and how it was sampled. """
+    if not est_rows:
+        return f"SELECT * FROM ({source}) AS s LIMIT {SAMPLE_ROWS}", "first rows"
+    if est_rows <= SAMPLE_ROWS:
+        return f"SELECT * FROM ({source}) AS s LIMIT {SAMPLE_ROWS}", "all rows"
+    # Ask for a bit more than we need, the estimate is only an estimate
+    fraction = min(1.0, 2 * SAMPLE_ROWS / est_rows)
+    if dialect == "postgresql" and table:
+        return f"SELECT * FROM {table} TABLESAMPLE SYSTEM ({fraction * 100:.6f}) LIMIT {SAMPLE_ROWS}", "TABLESAMPLE SYSTEM"
+    if dialect in RANDOM_FUNCTION:
+        return f"SELECT * FROM ({source}) AS s WHERE {RANDOM_FUNCTION[dialect]} < {fraction:.8f} LIMIT {SAMPLE_ROWS}", "random sample"
+    return f"SELECT * FROM ({source}) AS s LIMIT {SAMPLE_ROWS}", "first rows"
+
+def fetch_sample(engine, connection, backend_id, sql) -> pd.DataFrame:
+    with query_guard.tracked(engine, backend_id):
+        result = connection.exec_driver_sql(sql)
+        return pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()))
+
+def aggregate_sql(connection, source, sample):
+    """ One pass over every row: row count, non-null counts, min/max and (where the
+        database has it) approximate distinct counts. Returns (sql, [(column, stat)]).
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    exprs, keys = ["count(*)"], [(None, "rows")]
+    approx_distinct = connection.dialect.name in ["mysql", "singlestoredb"]
+    for column in sample.columns:
+        col = quote(column)
+        exprs.append(f"count({col})")
+        keys.append((column, "count"))
+        if column_kind(as_numeric(sample[column])) in ["numeric", "datetime"]:
+            exprs += [f"min({col})", f"max({col})"]
+            keys += [(column, "min"), (column, "max")]
+        if approx_distinct:
+            exprs.append(f"approx_count_distinct({col})")
+            keys.append((column, "distinct"))
+    return f"SELECT {', '.join(exprs)} FROM ({source}) AS p", keys
+
+def postgres_distinct(connection, table, total_rows):
+    """ {column: distinct estimate} from the planner statistics of a Postgres table. """
+    schema, _, name = table.rpartition(".")
+    rows = connection.exec_driver_sql(
+        "SELECT attname, n_distinct FROM pg_stats WHERE tablename = %(name)s"
+        + (" AND schemaname = %(schema)s" if schema else " AND schemaname = ANY(current_schemas(false))"),
+        {"name": name, "schema": schema}
+    ).fetchall()
+    # Negative values are a fraction of the row count
+    return {col: int(-n * total_rows if n < 0 else n) for col, n in rows if n is not None}
+
+def describe_column(name, series, stats, sample_rows, total_rows):
+    series = as_numeric(series)
+    kind = column_kind(series)
+    values = series.dropna()
+    count = stats.get("count", len(values) * (total_rows or 0) / max(sample_rows, 1))
+    parts = [f"{name} {kind}:"]
+    if total_rows:
+        parts.append(f"null {100 * (1 - count / total_rows):.1f}%,")
+    counts = values.value_counts()
+    distinct = stats.get("distinct")
+    if distinct is None:
+        distinct = estimate_distinct(counts, len(values), count)
+    parts.append(f"distinct ~{int(distinct):,},")
+
+    if kind == "numeric" and len(values):
+        data = values.to_numpy(dtype=float)
+        low = stats.get("min", data.min())
+        high = stats.get("max", data.max())
+        parts.append(f"min {format_value(low)}, max {format_value(high)},")
+        quantiles = np.quantile(data, QUANTILES)
+        parts.append(" ".join(f"p{int(q * 100)} {format_value(float(v))}" for q, v in zip(QUANTILES, quantiles)) + ",")
+        if distinct > LOW_CARDINALITY:
+            hist, edges = np.histogram(data, bins=HISTOGRAM_BINS)
+            shares = " ".join(str(int(round(100 * h / len(data)))) for h in hist)
+            parts.append(f"hist[{format_value(float(edges[0]))}..{format_value(float(edges[-1]))}] {shares} %")
+    elif kind == "datetime" and len(values):
+        parts.append(f"min {format_value(stats.get('min', values.min()))}, max {format_value(stats.get('max', values.max()))},")
+    elif kind == "text" and len(values):
+        lengths = values.astype(str).str.len()
+        parts.append(f"length {int(lengths.min())}-{int(lengths.max())} (avg {lengths.mean():.0f}),")
+
+    if len(counts) and (distinct <= LOW_CARDINALITY or counts.iloc[0] > 1 and kind in ["text", "bool"]):
+        top = ", ".join(
+            f"{format_value(value, 40)} {100 * n / len(values):.0f}%" for value, n in counts.head(TOP_VALUES).items()
+        )
+        parts.append(f"top: {top}")
+    return " ".join(parts).rstrip(",")
+
+def profile(engine, table=None, query=None, max_bytes=None):
+    """ Compact per-column summary of a table or query result.
+
+        Row counts, null fractions and min/max come from a single aggregation pass over
+        every row (when the cost guard allows it); quantiles, histograms and top values
+        are computed with NumPy on a sample fetched with TABLESAMPLE or a random filter.
+    """
+    if table is not None:
+        if not IDENTIFIER_RE.match(table):
+            raise ValueError(f"Invalid table name '{table}'")
+        source = f"SELECT * FROM {table}"
+    else:
+        source = query.strip().rstrip(';')
+
+    with tracer.span("profile", table=table), engine.connect() as connection:
+        backend_id = query_guard.prepare_connection(connection)
+        dialect = connection.dialect.name
+        try:
+            _, est_rows = query_guard.estimate(connection, source)
+        except Exception:
+            connection.rollback()
+            est_rows = None
+
+        sql, method = sample_sql(dialect, table, source, est_rows)
+        try:
+            sample = fetch_sample(engine, connection, backend_id, sql)
+        except Exception:
+            if method != "TABLESAMPLE SYSTEM":
+                raise
+            # Views (and some foreign tables) can't be sampled with TABLESAMPLE
+            connection.rollback()
+            sql, method = sample_sql(dialect, None, source, est_rows)
+            sample = fetch_sample(engine, connection, backend_id, sql)
+        tracer.count("rows_fetched", len(sample))
+        if method == "first rows" and len(sample) < SAMPLE_ROWS:
+            method = "all rows"
+
+        stats, note = {}, None
+        agg_sql, keys = aggregate_sql(connection, source, sample)
+        try:
+            query_guard.check_query(connection, agg_sql)
+            with tracer.span("profile.aggregate"), query_guard.tracked(engine, backend_id):
+                row = connection.exec_driver_sql(agg_sql).fetchone()
+            for (column, stat), value in zip(keys, row):
+                if value is not None:
+                    stats.setdefault(column, {})[stat] = float(value) if isinstance(value, decimal.Decimal) else value
+        except query_guard.QueryRejected as e:
+            note = f"no full scan ({e})"
+        except Exception as e:
+            connection.rollback()
+            note = f"no full scan ({e})"
+
+        total_rows = stats.get(None, {}).get("rows")
+        if total_rows is None:
+            total_rows = len(sample) if method == "all rows" else est_rows
+        if table is not None and dialect == "postgresql" and total_rows:
+            try:
+                for column, distinct in postgres_distinct(connection, table, total_rows).items():
+                    stats.setdefault(column, {}).setdefault("distinct", distinct)
+            except Exception:
+                connection.rollback()
+
+    exact = None in stats
+    header = [
+        f"# profile: {table or 'query'}",
+        f"# rows: {int(total_rows or 0):,} ({'exact' if exact else 'estimated'}), sample: {len(sample):,} rows ({method})",
+    ]
+    if exact and method != "all rows":
+        header.append("# nulls, min/max cover every row; quantiles, histograms and top values are from the sample")
+    if note:
+        header.append("# " + note)
+    lines = header[:]
+    max_bytes = max_bytes or 4000
+    size = sum(len(line) + 1 for line in lines)
+    for i, column in enumerate(sample.columns):
+        line = describe_column(column, sample[column], stats.get(column, {}), len(sample), total_rows)
+        if size + len(line) + 1 > max_bytes:
+            lines.append(f"# ...{len(sample.columns) - i} more columns not shown")
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
@@ -0,0 +1,133 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+class Span:
+    __slots__ = ("name", "start", "duration", "thread", "turn", "attrs")
+
+    def __init__(self, name, start, duration, thread, turn, attrs):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.thread = thread
+        self.turn = turn
+        self.attrs = attrs
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "thread": self.thread,
+            "turn": self.turn,
+            **self.attrs,
+        }
+
+class Tracer:
+    """ Collects timing spans and counters for the session, grouped by turn.
+
+        Spans can nest and can be recorded from worker threads. The collected data
+        can be summarized per turn or for the whole session, or exported as
+        JSON-lines or as a Chrome trace (chrome://tracing, Perfetto).
+    """
+    def __init__(self):
+        self.epoch = time.perf_counter()
+        self.spans = []
+        self.turns = []
+        self.turn = None
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.spans.append(Span(
+                    name, start - self.epoch, end - start, threading.get_ident(),
+                    self.turn["index"] if self.turn else None, attrs
+                ))
+
+    @contextmanager
+    def api_call(self, name, **attrs):
+        self.count("api_calls")
+        with self.span("api." + name, **attrs) as span_attrs:
+            yield span_attrs
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+            if self.turn is not None:
+                self.turn["counters"][name] += n
+
+    def start_turn(self, label=""):
+        with self.lock:
+            self.turn = {
+                "index": len(self.turns) + 1,
+                "label": label[:60],
+                "start": time.perf_counter() - self.epoch,
+                "duration": None,
+                "counters": Counter(),
+            }
+            self.turns.append(self.turn)
+
+    def end_turn(self):
+        with self.lock:
+            if self.turn is not None:
+                self.turn["duration"] = time.perf_counter() - self.epoch - self.turn["start"]
+                self.turn = None
+
+    def span_totals(self, turn=None):
+        """ {span name: (count, total seconds)} for one turn or the whole session. """
+        totals = defaultdict(lambda: [0, 0.0])
+        with self.lock:
+            for span in self.spans:
+                if turn is None or span.turn == turn:
+                    totals[span.name][0] += 1
+                    totals[span.name][1] += span.duration
+        return dict(totals)
+
+    def report(self, last_turns=5):
+        lines = []
+        with self.lock:
+            turns = [t for t in self.turns if t["duration"] is not None][-last_turns:]
+        for t in turns:
+            counters = ", ".join(f"{k}={v}" for k, v in sorted(t["counters"].items()))
+            lines.append(f"turn {t['index']} ({t['duration'] * 1000:.0f} ms) {t['label']!r}  {counters}")
+            for name, (n, total) in sorted(self.span_totals(t["index"]).items(), key=lambda i: -i[1][1]):
+                lines.append(f"    {name:<28} {n:>4}x {total * 1000:10.1f} ms")
+        lines.append("session:  " + ", ".join(f"{k}={v}" for k, v in sorted(self.counters.items())))
+        for name, (n, total) in sorted(self.span_totals().items(), key=lambda i: -i[1][1]):
+            lines.append(f"    {name:<28} {n:>4}x {total * 1000:10.1f} ms  (mean {total / n * 1000:.1f} ms)")
+        return "\n".join(lines)
+
+    def export(self, path):
+        """ Write spans to `path`: a Chrome trace for .json, JSON-lines otherwise. """
+        path = os.path.expanduser(path)
+        with self.lock:
+            spans = list(self.spans)
+            turns = list(self.turns)
+        with open(path, 'w') as f:
+            if path.endswith(".json"):
+                events = [{
+                    "name": s.name, "ph": "X", "pid": os.getpid(), "tid": s.thread,
+                    "ts": s.start * 1e6, "dur": s.duration * 1e6,
+                    "args": {"turn": s.turn, **s.attrs},
+                } for s in spans]
+                events += [{
+                    "name": f"turn {t['index']}", "ph": "X", "pid": os.getpid(), "tid": 0,
+                    "ts": t["start"] * 1e6, "dur": (t["duration"] or 0) * 1e6,
+                    "args": {"label": t["label"], **t["counters"]},
+                } for t in turns]
+                f.write(json.dumps({"traceEvents": events}))
+            else:
+                for s in spans:
+                    f.write(json.dumps(s.to_dict(), default=str) + "\n")
+
+tracer = Tracer()
@@ -1,11 +1,35 @@
 import os
 import csv
-from sqlalchemy import text
 from tabulate import tabulate
 
-# Currently none of these functions are used.
+class StepPrinter:
+    """ Stands in for a spinner: each step is printed on its own line, or swallowed
+        when `quiet` (batch mode, benchmarks), where progress output makes no sense.
+    """
+    text = ""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+
+    def start(self, text=None):
+        if text and not self.quiet:
+            print(text)
+
+    def stop(self):
+        pass
+
+def write_atomic(path, data: str):
+    # Write to a temp file and rename so a crash can't leave a truncated file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# Currently none of the functions below are used.
 
 def more_functions(engine, name, fargs):
+    from sqlalchemy import text
+
     if name == "list_schemas":
         with engine.connect() as connection:
             rows = connection.execute(text("SELECT schema_name FROM information_schema.schemata"))
@@ -52,6 +76,7 @@ def more_functions(engine, name, fargs):
 
 # This was an attempt to collect the database schema and make it available
 # via RAG to the LLM. But none of my experiments with that worked very well.
+# See catalog.py and schema_index.py for the local retrieval that replaced it.
 
 def download_database_schema(pg_connection):
     if not os.path.exists('./schema.md'):
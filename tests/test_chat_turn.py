@@ -0,0 +1,142 @@
+""" One chat turn end to end: the question cache, the async run driver and a tool
+    call against SQLite, with the Assistants API replaced by benchmarks/fake_openai.py.
+"""
+import asyncio
+import os
+import threading
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from benchmarks.bench import make_app
+from benchmarks.fake_openai import FakeOpenAI
+from gptsql import func_tools
+from gptsql.question_cache import QuestionCache, normalize_question
+
+QUESTION = "How many orders are there?"
+
+ANSWER_WITH_SQL = [
+    {"tool_calls": [{"name": "run_sql_command", "arguments": {"query": "SELECT count(*) AS n FROM orders"}}]},
+    {"message": "There are 3 orders."},
+]
+
+class StubCatalog:
+    fingerprint = "schema-v1"
+
+    def wait(self, timeout=None):
+        return True
+
+class StubSchemaIndex:
+    def schema_slice(self, question):
+        return "customers(id, region)" if "customer" in question else "orders(id, amount)"
+
+def done_thread():
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+    return thread
+
+@pytest.fixture
+def app(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE orders (id INTEGER, amount REAL)"))
+        connection.execute(text("INSERT INTO orders VALUES (1, 10.0), (2, 20.0), (3, 30.0)"))
+
+    def build(script):
+        client = FakeOpenAI(script=script)
+        app = make_app(engine, client, str(tmp_path), max_parallel_queries=2)
+        app.catalog = StubCatalog()
+        app.schema_index = StubSchemaIndex()
+        app.question_cache = QuestionCache(path=os.path.join(tmp_path, "questions.json"))
+        app.context_budget = 100_000
+        app.setup_threads = {"database": done_thread(), "assistant": done_thread()}
+        app.setup_errors = {}
+        return app, client
+
+    func_tools.result_cache.invalidate()
+    yield build
+    engine.dispose()
+
+def test_turn_answers_and_remembers_question(app):
+    gptsql, client = app([ANSWER_WITH_SQL])
+
+    asyncio.run(gptsql.run_turn(QUESTION))
+
+    entry = gptsql.question_cache.entries[normalize_question(QUESTION)]
+    assert entry["sql"] == "SELECT count(*) AS n FROM orders"
+    assert entry["answer"] == "There are 3 orders."
+    assert entry["fingerprint"] == "schema-v1"
+    assert client.calls["runs.create"] == 1
+
+    # Asking again replays the remembered SQL without a run
+    asyncio.run(gptsql.run_turn(QUESTION))
+    assert client.calls["runs.create"] == 1
+    assert gptsql.question_cache.hits == 1
+
+def test_every_standalone_question_in_a_thread_is_remembered(app):
+    gptsql, client = app([ANSWER_WITH_SQL, ANSWER_WITH_SQL])
+
+    asyncio.run(gptsql.run_turn("Show me the orders"))
+    asyncio.run(gptsql.run_turn(QUESTION))
+
+    assert client.calls["runs.create"] == 2
+    assert len(gptsql.question_cache.entries) == 2
+
+def test_follow_up_question_is_not_remembered(app):
+    gptsql, client = app([ANSWER_WITH_SQL, ANSWER_WITH_SQL])
+
+    asyncio.run(gptsql.run_turn("Show me the orders"))
+    assert len(gptsql.question_cache.entries) == 1
+    gptsql.question_cache.forget()
+    asyncio.run(gptsql.run_turn("and how many are there?"))
+
+    assert client.calls["runs.create"] == 2
+    assert gptsql.question_cache.entries == {}
+
+def test_answer_from_stored_results_is_not_remembered(app):
+    gptsql, client = app([[
+        {"tool_calls": [{"name": "run_sql_command", "arguments": {"query": "SELECT * FROM orders"}}]},
+        {"tool_calls": [{"name": "query_stored_results", "arguments": {"query": "SELECT count(*) FROM r1"}}]},
+        {"message": "There are 3 orders."},
+    ]])
+
+    asyncio.run(gptsql.run_turn(QUESTION))
+
+    assert gptsql.turn_used_stored_results
+    assert gptsql.turn_queries == ["SELECT * FROM orders"]
+    assert gptsql.question_cache.entries == {}
+
+def seed_of(gptsql, client):
+    return client.threads_by_id[gptsql.thread.id].messages[0].content[0].text.value
+
+@pytest.mark.parametrize("second, previous_slice_in_seed", [
+    ("How many customers are there?", True),
+    ("What is the largest order amount?", False),
+])
+def test_rollover_seed_carries_the_previous_schema_slice(app, second, previous_slice_in_seed):
+    gptsql, client = app([ANSWER_WITH_SQL, ANSWER_WITH_SQL])
+    asyncio.run(gptsql.run_turn("Show me the orders"))
+    first_thread = gptsql.thread.id
+    gptsql.context_budget = 0
+
+    asyncio.run(gptsql.run_turn(second))
+
+    assert gptsql.thread.id != first_thread
+    seed = seed_of(gptsql, client)
+    assert "Q: Show me the orders" in seed
+    # The second question's own slice arrives with its message, so the seed never repeats it
+    assert ("orders(id, amount)" in seed) == previous_slice_in_seed
+    assert "customers(id, region)" not in seed
+
+def test_failed_turn_still_counts_towards_the_budget(app):
+    gptsql, client = app([ANSWER_WITH_SQL])
+
+    async def fail(**kwargs):
+        raise RuntimeError("connection reset")
+    gptsql.async_oaclient.beta.threads.runs.submit_tool_outputs = fail
+
+    asyncio.run(gptsql.run_turn(QUESTION))
+
+    assert gptsql.state["thread_tokens"] > 0
+    assert gptsql.state.get("findings", []) == []
@@ -0,0 +1,40 @@
+import json
+from types import SimpleNamespace as NS
+
+import pytest
+
+from gptsql import query_guard
+from gptsql.query_guard import QueryRejected, check_query
+
+class PlanConnection:
+    """ Answers EXPLAIN with a canned plan and records what was run. """
+    def __init__(self, dialect, plan):
+        self.dialect = NS(name=dialect)
+        self.plan = plan
+        self.statements = []
+
+    def exec_driver_sql(self, sql):
+        self.statements.append(sql)
+        return NS(fetchall=lambda: [(json.dumps(self.plan),)], scalar=lambda: self.plan)
+
+SINGLESTORE_PLAN = {"executor": "Gather", "inputs": [{"executor": "TableScan", "est_rows": "250000000"}]}
+
+def test_singlestore_rejects_large_scans_by_default():
+    connection = PlanConnection("singlestoredb", SINGLESTORE_PLAN)
+
+    with pytest.raises(QueryRejected, match="250,000,000 rows"):
+        check_query(connection, "SELECT * FROM events")
+
+def test_postgres_rejects_expensive_plans():
+    connection = PlanConnection("postgresql", [{"Plan": {"Total Cost": 5e7, "Plan Rows": 10}}])
+
+    with pytest.raises(QueryRejected, match="estimated cost"):
+        check_query(connection, "SELECT * FROM a, b")
+
+def test_explain_is_skipped_when_no_limit_applies(monkeypatch):
+    monkeypatch.setattr(query_guard, "MAX_ESTIMATED_ROWS", None)
+    connection = PlanConnection("singlestoredb", SINGLESTORE_PLAN)
+
+    check_query(connection, "SELECT * FROM events")
+
+    assert connection.statements == []
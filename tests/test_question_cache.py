@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from gptsql.question_cache import QuestionCache, is_follow_up, normalize_question
+
+@pytest.mark.parametrize("a, b", [
+    ("How many orders?", "Show me the orders"),
+    ("How many orders?", "List all orders"),
+    ("Which customers are from the US?", "How many customers are from the US?"),
+    ("Orders over 100", "Orders under 100"),
+    ("orders > 100", "orders < 100"),
+    ("Revenue in 2023", "Revenue in 2024"),
+    ("Top 10 customers by revenue", "Top 100 customers by revenue"),
+    ("Daily signups last week", "Weekly signups last day"),
+])
+def test_different_questions_get_different_keys(a, b):
+    assert normalize_question(a) != normalize_question(b)
+
+@pytest.mark.parametrize("a, b", [
+    ("How many orders?", "how many orders"),
+    ("How  many Orders??", "how many order"),
+    ("Top 10 customers, by revenue.", "top 10 customer by revenue"),
+])
+def test_same_question_gets_the_same_key(a, b):
+    assert normalize_question(a) == normalize_question(b)
+
+@pytest.mark.parametrize("question", [
+    "and last month?",
+    "Now group that by region",
+    "only the US",
+    "Sort them by revenue",
+    "What about r3?",
+    "count the rows in last_result",
+    "show the results again",
+])
+def test_follow_ups(question):
+    assert is_follow_up(question)
+
+@pytest.mark.parametrize("question", [
+    "How many orders are there?",
+    "Daily signups last week",
+    "Top 10 customers by revenue",
+    "Which customers signed up this month?",
+])
+def test_standalone_questions(question):
+    assert not is_follow_up(question)
+
+def test_load_rekeys_entries_saved_under_an_older_normalization(tmp_path):
+    path = tmp_path / "questions.json"
+    path.write_text(json.dumps([{
+        "key": "order", "question": "How many orders?", "fingerprint": "f", "sql": "SELECT count(*) FROM orders",
+        "answer": "3", "created": 0, "used_at": 0, "hits": 0,
+    }]))
+    cache = QuestionCache(path=str(path))
+
+    cache.load()
+
+    assert cache.get("orders", "f") is None
+    assert cache.get("How many orders?", "f")["sql"] == "SELECT count(*) FROM orders"
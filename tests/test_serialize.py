@@ -0,0 +1,51 @@
+import json
+
+import pandas as pd
+
+from gptsql.serialize import format_value, serialize_result
+
+def test_floats_keep_their_digits():
+    df = pd.DataFrame({"total": [12345678.91, 0.1 + 0.2, 3.0, 987654321012.25]})
+
+    out = serialize_result(df, fmt="csv")
+
+    assert out.splitlines()[1:] == ["total", "12345678.91", "0.3", "3", "987654321012.25"]
+
+def test_missing_values_are_blank():
+    assert format_value(None) == ""
+    assert format_value(float("nan")) == ""
+    assert format_value(pd.NaT) == ""
+
+def test_metadata_reaches_the_model():
+    df = pd.DataFrame({"id": range(20)})
+
+    out = serialize_result(df, total_rows=5000, more_rows=True, meta={"result_id": "r3"})
+
+    assert out.splitlines()[:2] == ["# result_id: r3", "# rows: 20 of 5000+"]
+
+def test_rows_are_dropped_to_fit_the_budget():
+    df = pd.DataFrame({"id": range(1000), "name": [f"customer {i}" for i in range(1000)]})
+
+    out = serialize_result(df, max_bytes=500)
+
+    assert len(out.encode()) <= 500
+    assert "# rows: " in out and " of 1000" in out
+    assert "customer 0" in out
+
+def test_long_values_are_cut():
+    df = pd.DataFrame({"note": ["x" * 500], "blob": [b"\x00" * 64]})
+
+    out = serialize_result(df, fmt="markdown")
+
+    assert "x" * 119 + "…" in out
+    assert "<64 bytes>" in out
+    assert "truncated_columns: note (values cut to 120 chars)" in out
+
+def test_columns_format_is_json():
+    df = pd.DataFrame({"a": [1, 2], "b": [1.5, None]})
+
+    out = json.loads(serialize_result(df, fmt="columns", meta={"result_id": "r1"}))
+
+    assert out["columns"] == ["a", "b"]
+    assert out["data"] == {"a": ["1", "2"], "b": ["1.5", ""]}
+    assert out["meta"] == {"result_id": "r1", "rows": "2 of 2"}
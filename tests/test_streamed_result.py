@@ -0,0 +1,84 @@
+import pytest
+from sqlalchemy import create_engine, event, text
+
+from gptsql import func_tools
+from gptsql.func_tools import StreamedResult, call_my_function, result_cache, result_store
+
+ROWS = 2500
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE orders (id INTEGER, amount REAL)"))
+        connection.execute(text("INSERT INTO orders VALUES " + ",".join(f"({i}, {i * 1.5})" for i in range(ROWS))))
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, sql, *args: statements.append(sql))
+    engine.statements = statements
+    result_cache.invalidate()
+    result_store.clear()
+    yield engine
+    result_store.clear()
+    result_cache.invalidate()
+    engine.dispose()
+
+def test_rest_of_result_is_spilled_and_cursor_released(engine):
+    result = StreamedResult(engine, "SELECT * FROM orders ORDER BY id")
+    assert len(result.first) == func_tools.FETCH_CHUNK_ROWS
+
+    result.wait()
+
+    assert result.complete and not result.more_rows
+    assert result.row_count == ROWS
+    assert result.connection is None
+    assert engine.pool.checkedout() == 0
+    assert list(result.page(2490, 20)["id"]) == list(range(2490, ROWS))
+    assert engine.statements == ["SELECT * FROM orders ORDER BY id"]
+    result.discard()
+
+def test_rows_past_the_budget_are_reported(engine):
+    result = StreamedResult(engine, "SELECT * FROM orders", max_rows=1500)
+    result.wait()
+
+    assert result.truncated and result.more_rows
+    assert result.row_count == 2000
+    result.discard()
+
+def test_paging_an_older_result_never_reruns_the_query(engine):
+    call_my_function(engine, "run_sql_command", {"query": "SELECT * FROM orders ORDER BY id"})
+    first_id = result_store.get().id
+    call_my_function(engine, "run_sql_command", {"query": "SELECT * FROM orders ORDER BY amount DESC"})
+    ran = len(engine.statements)
+
+    out = call_my_function(engine, "get_query_results_page", {"result_id": first_id, "start_row": 2000, "num_rows": 3})
+
+    assert "2000,3000" in out
+    assert len(engine.statements) == ran
+
+def test_cache_hit_holds_every_row(engine):
+    query = "SELECT * FROM orders ORDER BY id"
+    call_my_function(engine, "run_sql_command", {"query": query})
+    result_store.get().wait()
+    ran = len(engine.statements)
+
+    call_my_function(engine, "run_sql_command", {"query": query})
+    out = call_my_function(engine, "get_query_results_page", {"start_row": 2400, "num_rows": 2})
+
+    assert "2400,3600" in out
+    assert "# rows: 2 of 2500\n" in out
+    assert len(engine.statements) == ran
+
+def test_results_are_scoped_to_their_thread(engine):
+    call_my_function(engine, "run_sql_command", {"query": "SELECT * FROM orders"}, "thread_a")
+    call_my_function(engine, "run_sql_command", {"query": "SELECT * FROM orders WHERE id < 5"}, "thread_b")
+    b_id = result_store.get(scope="thread_b").id
+    result_store.get(scope="thread_a").wait()
+
+    page = call_my_function(engine, "get_query_results_page", {"start_row": 0, "num_rows": 1}, "thread_a")
+    local = call_my_function(engine, "query_stored_results", {"query": "SELECT count(*) AS n FROM last_result"}, "thread_a")
+    other = call_my_function(engine, "get_query_results_page", {"result_id": b_id}, "thread_a")
+
+    assert "of 2500" in page
+    assert "\n2500" in local
+    assert "error" in other
+    assert len(result_store.get(b_id).first) == 5